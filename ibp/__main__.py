@@ -3,6 +3,8 @@ import sys
 from .libs.deposits import main as deposits_main
 from .libs.dividends import main as dividends_main
 from .libs.helpers import get_common_argument_parser
+from .libs.http_client import http_client
+from .libs.models import init_db
 from .libs.portfolio import main as portfolio_main
 from .libs.report_realized import main as report_realized_main
 from .libs.transactions import main as transactions_main
@@ -33,6 +35,7 @@ def main():
         assert not any(
             [i.startswith("-") for i in args.instruments_filter]
         ), "Bad order of args, put instruments at end"
+    init_db()
     if sysargs[0] == "transactions":
         transactions_main(
             args.instruments_filter,
@@ -64,6 +67,7 @@ def main():
         from .libs.check_portfolio import main
 
         main()
+    http_client.log_stats()
 
 
 if __name__ == "__main__":
@@ -1,3 +1,4 @@
+import sys
 from collections import defaultdict
 from datetime import timedelta
 from itertools import chain
@@ -9,6 +10,7 @@ from .config import config
 from .corporate_actions import CorporateActionParser
 from .dividends import DividendParser
 from .helpers import get_latest_file
+from .models import init_db
 from .parser import CSVReader
 from .portfolio import Portfolio
 from .transactions import Transaction, TransactionParser
@@ -16,7 +18,7 @@ from .transactions import Transaction, TransactionParser
 
 def main():
     csv_path = config.get("csv_path")
-    reader = CSVReader(csv_path)
+    reader = CSVReader(csv_path, patterns=TransactionParser.patterns)
     transactions = TransactionParser(reader).get_csv_transactions()
     CorporateActionParser(reader).apply_actions(transactions)
     latest = get_latest_file(csv_path)
@@ -35,4 +37,5 @@ def main():
 
 
 if __name__ == "__main__":
+    init_db()
     sys.exit(main())
@@ -22,7 +22,7 @@ class MoneyMoveParser(object):
         super(MoneyMoveParser, self).__init__()
 
     def parse_money_lines(self):
-        lines = self.reader.get_money_move_lines()
+        lines = self.reader.get_money_move_lines(self.date_delta)
         reader = csv.reader(lines, delimiter=",")
         moves = {}
         for row in reader:
@@ -58,7 +58,7 @@ class MoneyMoveParser(object):
 
 
 def main(display_currency=None, filter_currency=None, date_delta=None, machine_readable=False):
-    reader = CSVReader(config.get("csv_path"))
+    reader = CSVReader(config.get("csv_path"), patterns=[CSVReader.money_move_pattern])
     parser = MoneyMoveParser(reader, display_currency, date_delta, machine_readable, filter_currency)
     money_moves = sorted(parser.parse_money_lines().values(), key=lambda d: d.date)
     parser.print_money_moves(money_moves)
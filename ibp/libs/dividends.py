@@ -5,12 +5,15 @@ from datetime import datetime
 
 from .config import config
 from .helpers import ignore_due_time_constraint, parse_date_delta
-from .instruments import db, ignore_instrument
+from .instruments import db, extract_symbol, ignore_instrument
 from .logging import log
 from .money import Money
-from .parser import CSVReader
+from .parser import CSVReader, compile_schema, filter_lines
 
 Dividend = namedtuple("Dividend", ["timestamp", "currency", "instrument", "amount_total"])
+DividendRow = namedtuple("DividendRow", ["currency", "date_activity", "description", "amount"])
+# Column titles per DividendRow field as found in 'Dividends,Header,...' lines
+DIVIDEND_TITLES = (("Currency",), ("Date",), ("Description",), ("Amount",))
 
 
 class Dividend(object):
@@ -47,48 +50,71 @@ class DividendParser(object):
 
     def parse_dividend_lines(self):
         """Reads dividends received lines (=not accruals) from IB monthly statements into a list of namedtuples"""
-        lines = self.reader.get_dividend_lines()
-        reader = csv.reader(lines, delimiter=",")
+        conditions = self._get_line_conditions()
         dividends = {}
-        for row in reader:
-            if re.match(r"^U\d+$", row[3]):
-                _, _, currency, _, date_activity, description, amount = row
-            elif len(row) == 6:
-                _, _, currency, date_activity, description, amount = row
-            elif len(row) == 7:
-                _, _, currency, date_activity, description, amount, _ = row
-            else:
-                raise Exception("Unknown row format")
-
-            date_activity = datetime.strptime(date_activity, "%Y-%m-%d")
-            if self.filter_currency and self.filter_currency != currency:
-                continue
-            if ignore_due_time_constraint(self.date_delta, date_activity):
-                continue
-            symbol_ib = description.split("(")[0].strip()
-            if ignore_instrument(None, [symbol_ib], self.instruments_filter):
-                continue
-            security_id = description.split("(")[1].split(")")[0]
-            if len(currency.split()[0]) == 3:
-                currency = currency.split()[0]
-            else:
-                currency = currency.split()[1]
-            db_instrument = db.get_by_symbol_ib(symbol_ib)
-            if not db_instrument:
-                db_instrument = db.get_by_security_id(security_id)
-
-            amount = Money(float(amount), currency)
-            key = "{}-{}-{}-{}".format(date_activity, symbol_ib, security_id, amount.as_float)
-            if key in dividends:
-                d = dividends[key]
-                if d.description == description and "LU0378438732" not in description:
-                    log.debug("Skipping duplicate dividend: {}".format(key))
-                    continue
-                dividends[key + "-2"] = Dividend(date_activity, currency, db_instrument, amount, description)
-            else:
-                dividends[key] = Dividend(date_activity, currency, db_instrument, amount, description)
+        for _, header, lines in self.reader.get_dividend_sections(self.date_delta):
+            extract = compile_schema(header, DividendRow, DIVIDEND_TITLES)
+            lines = filter_lines(lines, header, DividendRow, DIVIDEND_TITLES, conditions)
+            for row in csv.reader(lines, delimiter=","):
+                self._add_dividend(dividends, extract, row)
         return sorted(dividends.values(), key=lambda d: d.timestamp)
 
+    def _add_dividend(self, dividends, extract, row):
+        """Parses a row with the section's extract function, or by its length without one, into dividends by key"""
+        if extract:
+            currency, date_activity, description, amount = extract(row)
+        elif re.match(r"^U\d+$", row[3]):
+            _, _, currency, _, date_activity, description, amount = row
+        elif len(row) == 6:
+            _, _, currency, date_activity, description, amount = row
+        elif len(row) == 7:
+            _, _, currency, date_activity, description, amount, _ = row
+        else:
+            raise Exception("Unknown row format")
+
+        date_activity = datetime.strptime(date_activity, "%Y-%m-%d")
+        if self.filter_currency and self.filter_currency != currency:
+            return
+        if ignore_due_time_constraint(self.date_delta, date_activity):
+            return
+        symbol_ib = description.split("(")[0].strip()
+        if ignore_instrument(None, [symbol_ib], self.instruments_filter):
+            return
+        security_id = description.split("(")[1].split(")")[0]
+        if len(currency.split()[0]) == 3:
+            currency = currency.split()[0]
+        else:
+            currency = currency.split()[1]
+        db_instrument = db.get_by_symbol_ib(symbol_ib)
+        if not db_instrument:
+            db_instrument = db.get_by_security_id(security_id)
+
+        amount = Money(float(amount), currency)
+        key = "{}-{}-{}-{}".format(date_activity, symbol_ib, security_id, amount.as_float)
+        if key in dividends:
+            d = dividends[key]
+            if d.description == description and "LU0378438732" not in description:
+                log.debug("Skipping duplicate dividend: {}".format(key))
+                return
+            dividends[key + "-2"] = Dividend(date_activity, currency, db_instrument, amount, description)
+        else:
+            dividends[key] = Dividend(date_activity, currency, db_instrument, amount, description)
+
+    def _get_line_conditions(self):
+        """Currency and instrument filters to apply to csv lines before parsing them, see filter_lines."""
+        conditions = {}
+        if self.filter_currency:
+            conditions["currency"] = lambda currency: currency == self.filter_currency
+        if self.instruments_filter:
+            aliases = db.get_aliases(self.instruments_filter)
+
+            def keep(description):
+                symbol_ib = description.split("(")[0].strip()
+                return symbol_ib in aliases or extract_symbol(symbol_ib) in aliases
+
+            conditions["description"] = keep
+        return conditions
+
     def print_dividends(self, dividends):
         total = 0.0
         for d in dividends:
@@ -109,7 +135,7 @@ class DividendParser(object):
 
 
 def main(instruments_filter=None, display_currency=None, filter_currency=None, date_delta=None, machine_readable=False):
-    reader = CSVReader(config.get("csv_path"))
+    reader = CSVReader(config.get("csv_path"), patterns=[CSVReader.dividend_pattern])
     parser = DividendParser(reader, instruments_filter, display_currency, filter_currency, date_delta, machine_readable)
     dividends = parser.parse_dividend_lines()
     parser.print_dividends(dividends)
@@ -2,3 +2,9 @@ class BadYahooSymbolError(Exception):
     """Raised when a lookup of a symbol fails because yahoo did not know it."""
 
     pass
+
+
+class YahooResponseError(Exception):
+    """Raised when yahoo answers with an unexpected status, also after retrying."""
+
+    pass
@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta
+
+from .config import config
+from .logging import log
+from .models import FailedLookup as DBFailedLookup, db_writer
+
+
+class FailedLookups(object):
+    """
+    Remembers yahoo urls that did not know the instrument we asked for, so we don't request them again on every run.
+    Entries expire after failed_lookup_ttl_days, as yahoo may list the instrument by then.
+    """
+
+    failed = None
+
+    def get_failed(self):
+        if self.failed is None:
+            since = datetime.now() - timedelta(days=config.getint("failed_lookup_ttl_days", fallback=30))
+            lookups = DBFailedLookup.select().where(DBFailedLookup.timestamp > since)
+            self.failed = {lookup.url: lookup.outcome for lookup in lookups}
+        return self.failed
+
+    def is_failed(self, url):
+        outcome = self.get_failed().get(url)
+        if outcome:
+            log.debug("Skipping {}, failed before: {}".format(url, outcome))
+        return bool(outcome)
+
+    def add(self, url, outcome):
+        self.get_failed()[url] = outcome
+        query = DBFailedLookup.insert(url=url, outcome=outcome, timestamp=datetime.now()).on_conflict_replace()
+        db_writer.submit(query.execute)
+
+
+failed_lookups = FailedLookups()
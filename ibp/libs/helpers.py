@@ -3,6 +3,10 @@ import glob
 import re
 from datetime import date, datetime, timedelta
 from os import path
+from threading import Lock
+from time import monotonic, sleep
+
+from .config import config
 
 
 def parse_date_delta(date_delta):
@@ -95,3 +99,23 @@ def get_latest_file(csv_folder):
             latest_date = file_date
             latest_file = csv_file_name
     return latest_file
+
+
+class RateLimiter(object):
+    """Spaces out calls of wait() across all threads so they happen at most `per_second` times a second."""
+
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second if per_second > 0 else 0.0
+        self.next_call = 0.0
+        self.lock = Lock()
+
+    def wait(self):
+        with self.lock:
+            now = monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            sleep(delay)
+
+
+yahoo_rate_limiter = RateLimiter(config.getfloat("yahoo_requests_per_second", fallback=4.0))
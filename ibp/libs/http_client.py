@@ -0,0 +1,123 @@
+import os
+from collections import defaultdict
+from hashlib import sha1
+from threading import Lock, get_ident
+from time import monotonic, time
+from urllib.parse import urlsplit
+
+from urllib3 import HTTPResponse, PoolManager, Retry, Timeout
+
+from .config import config
+from .helpers import yahoo_rate_limiter
+from .logging import log
+
+# Default hours per type of endpoint to answer requests from the cache, see http_cache_hours_<type> in the config
+CACHE_HOURS = {"search": 168, "quote": 168}
+
+
+class ResponseCache(object):
+    """Bodies of successful responses, each in a file named after the sha1 of its url."""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def get_file_name(self, url):
+        digest = sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+
+    def get(self, url, max_age=None):
+        """Cached body for url, None if there is none or it is older than max_age seconds."""
+        file_name = self.get_file_name(url)
+        try:
+            if max_age is not None and time() - os.stat(file_name).st_mtime > max_age:
+                return None
+            with open(file_name, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, url, body):
+        file_name = self.get_file_name(url)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        temp_file_name = "{}.{}".format(file_name, get_ident())  # Readers must never see a partly written file
+        with open(temp_file_name, "wb") as f:
+            f.write(body)
+        os.replace(temp_file_name, file_name)
+
+
+class HTTPClient(object):
+    """
+    Shared by everything that talks to yahoo. Keeps connections alive in a pool, at most http_connections_per_host per
+    host, retries failed requests with exponential backoff and keeps count of requests and their latency per host.
+
+    Requests made with `cache` store successful responses in http_cache_path and are answered from there for
+    http_cache_hours_<cache> hours. With http_offline all requests are answered from there only, regardless of age.
+    """
+
+    def __init__(self):
+        self.retry = Retry(
+            total=config.getint("http_retries", fallback=3),
+            backoff_factor=config.getfloat("http_backoff_seconds", fallback=1.0),
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False,
+        )
+        self.pool = PoolManager(
+            maxsize=config.getint("http_connections_per_host", fallback=4),
+            block=True,  # Wait for a free connection instead of opening more than maxsize per host
+            timeout=Timeout(total=config.getfloat("http_timeout_seconds", fallback=10.0)),
+            retries=self.retry,
+        )
+        self.cache = ResponseCache(config.get("http_cache_path", fallback="~/.cache/ibparser/"))
+        self.offline = config.getboolean("http_offline", fallback=False)
+        self.stats = defaultdict(lambda: [0, 0.0])  # Host to number of requests and seconds spent on them
+        self.cache_hits = 0
+        self.lock = Lock()
+
+    def get(self, url, headers=None, retries=None, redirect=True, cache=None):
+        """
+        Returns the urllib3 response for url, also for error statuses once retries are used up. `retries` overrides the
+        number of retries for this request. `cache` is the type of endpoint, e.g. "search", for looking up its TTL.
+        When offline, urls not in the cache get a 504 response like HTTP caches give for only-if-cached requests.
+        """
+        if cache or self.offline:
+            max_age = None
+            if not self.offline:
+                max_age = (
+                    config.getfloat("http_cache_hours_{}".format(cache), fallback=CACHE_HOURS.get(cache, 0)) * 3600
+                )
+            body = self.cache.get(url, max_age)
+            if body is not None:
+                with self.lock:
+                    self.cache_hits += 1
+                log.debug("GET {} from cache".format(url))
+                return HTTPResponse(body=body, status=200)
+            if self.offline:
+                log.debug("GET {} not in cache while offline".format(url))
+                return HTTPResponse(body=b"", status=504)
+        if retries is not None:
+            retries = self.retry.new(total=retries)
+        yahoo_rate_limiter.wait()
+        start = monotonic()
+        response = self.pool.request("GET", url, headers=headers, retries=retries, redirect=redirect)
+        elapsed = monotonic() - start
+        with self.lock:
+            stats = self.stats[urlsplit(url).hostname]
+            stats[0] += 1
+            stats[1] += elapsed
+        log.debug("GET {} {} in {:.3f}s".format(url, response.status, elapsed))
+        if cache and response.status == 200:
+            self.cache.set(url, response.data)
+        return response
+
+    def get_stats(self):
+        """Number of requests and their average latency in seconds per host."""
+        with self.lock:
+            return {host: (count, seconds / count) for host, (count, seconds) in self.stats.items()}
+
+    def log_stats(self):
+        for host, (count, latency) in sorted(self.get_stats().items()):
+            log.info("{}: {} requests, {:.3f}s average".format(host, count, latency))
+        log.info("{} responses from cache".format(self.cache_hits))
+
+
+http_client = HTTPClient()
@@ -1,11 +1,17 @@
 import csv
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from .config import config
 from .constants import IB_EXCHANGE_TO_CURRENCY
 from .logging import log
-from .models import Instrument as DBInstrument, InstrumentIgnored as DBInstrumentIgnored
+from .models import (
+    Instrument as DBInstrument,
+    InstrumentAlias as DBInstrumentAlias,
+    InstrumentIgnored as DBInstrumentIgnored,
+    db_writer,
+)
 from .money import Money
-from .prices import PriceService, thread_price_service
+from .prices import thread_price_service
 from .yahoo_instrument_scraper import YahooSymbolPageScraper
 from .yahoo_json_search_scraper import get_yahoo_json_search_result
 
@@ -16,9 +22,10 @@ class Instrument(object):
     """
 
     currency = None
+    is_new = False  # Not in the database yet when created
     _db_instrument = None
 
-    def __init__(self, symbol_ib, name, con_id, security_id, currency=None, symbols_ib_additional=None):
+    def __init__(self, symbol_ib, name, con_id, security_id, currency=None, symbols_ib_additional=None, save=True):
         self.symbol_ib = symbol_ib
         self.name = name
         self.con_id = con_id
@@ -29,15 +36,16 @@ class Instrument(object):
         if self.symbol_ib.endswith(".OLD"):
             log.warning("Ignoring {} as no longer valid name.".format(self.symbol_ib))
         else:
-            self.symbol_yahoo, self.currency = self._get_yahoo_metadata()
+            self.symbol_yahoo, self.currency = self._get_yahoo_metadata(save)
 
     def __repr__(self):
         return "<{} {}>".format(self.symbol_ib, self.currency)
 
-    def _get_yahoo_metadata(self):
+    def _get_yahoo_metadata(self, save=True):
         """
         Returns the symbol name yahoo uses for this instrument, something we can't get from the IB csvs.
-        Tries to guess yahoo symbol name and confirms it by crawling yahoo. On success we save it in a simple csv.
+        Tries to guess yahoo symbol name and confirms it by crawling yahoo. On success we save it to the database,
+        unless save is False and the caller does that with db.add_many.
         """
         db_instrument = db.get(self.con_id)
 
@@ -71,7 +79,9 @@ class Instrument(object):
                     pass
                 else:
                     assert self.currency == yahoo_currency
-            db.add(self)
+            self.is_new = True
+            if save:
+                db.add(self)
             log.debug("-" * 5)
         return self.symbol_yahoo, self.currency
 
@@ -79,17 +89,13 @@ class Instrument(object):
         if not self.symbol_yahoo:
             log.warning("Can't get price for {}, as we don't have a yahoo symbol.".format(self))
             return Money(0.0, self.currency or config.get("default_currency"))
-        return PriceService(self).get(date_time)
+        return thread_price_service.get(self, date_time)
 
     def get_price_in_background(self, date=None):
         thread_price_service.submit(self, date)
 
     def get_all_known_symbols(self):
-        db_instrument = db.get(con_id=self.con_id)
-        symbols = [db_instrument.symbol_ib, db_instrument.symbol_yahoo]
-        if db_instrument.symbols_ib_additional:
-            symbols += db_instrument.symbols_ib_additional.split(",")
-        return symbols
+        return get_symbols(db.get(con_id=self.con_id))
 
 
 class InstrumentCollection(object):
@@ -139,15 +145,44 @@ class InstrumentParser(object):
         """
         lines = set(self.reader.get_instrument_lines())
         reader = csv.reader(lines, delimiter=",")
+        unknown = {}  # con_id to arguments for Instrument, per row of an instrument not in the database yet
         for row in reader:
             log.debug("Parsing instrument... {}".format(row[4]))
-            i = self._parse_row_to_instrument(row)
-            if i:
-                self.instruments[i.con_id] = i
+            args = self._parse_row_to_instrument_args(row)
+            if args:
+                unknown.setdefault(args[2], []).append(args)
+        for i in self._create_instruments([rows[0] for rows in unknown.values()]):
+            self.instruments[i.con_id] = i
+        for rows in unknown.values():
+            db_instrument = db.get(rows[0][2])
+            for symbol_ib, _, _, _, _, symbols_ib_additional in rows[1:]:
+                if db_instrument:
+                    db.update_symbols(db_instrument, [symbol_ib] + symbols_ib_additional)
         return self.instruments
 
-    def _parse_row_to_instrument(self, row):
-        """Single line in csv file to python namedtuple Instrument w/o adding or calculating additional data"""
+    def _create_instruments(self, instruments_args):
+        """
+        Creates instruments, looking up their yahoo metadata in worker threads as each can take several requests. Adds
+        them to the database in one transaction once done, also if some of them failed.
+        """
+        instruments, error = [], None
+        with ThreadPoolExecutor(max_workers=max(config.getint("yahoo_workers", fallback=4), 1)) as pool:
+            futures = [pool.submit(Instrument, *args, save=False) for args in instruments_args]
+            for future in as_completed(futures):
+                try:
+                    instruments.append(future.result())
+                except Exception as e:
+                    error = error or e
+        db.add_many(instruments)
+        if error:
+            raise error
+        return instruments
+
+    def _parse_row_to_instrument_args(self, row):
+        """
+        Arguments for creating an Instrument from a single line in a csv file. None if the instrument is ignored or
+        already in the database, in which case we record new IB symbols for it.
+        """
         # IB columns definition:
         # Financial Instrument Information,Header,Asset Category,Symbol,Description,Conid,Security ID,Multiplier,Type,Code
         _, _, _, symbol_ib, name, con_id, security_id, exchange = row[:8]
@@ -165,12 +200,12 @@ class InstrumentParser(object):
         if ignore_instrument(con_id, symbols, self.instrument_filter):
             return None
 
-        db_instrument = DBInstrument.get_or_none(con_id=con_id)
+        db_instrument = db.get(con_id)
         if db_instrument:
             db.update_symbols(db_instrument, symbols)
             return None  # Don't create new instrument
 
-        return Instrument(symbols[0], name, con_id, security_id, currency, symbols[1:])
+        return symbols[0], name, con_id, security_id, currency, symbols[1:]
 
     def print_instruments(self):
         for i in self.instruments.values():
@@ -189,59 +224,155 @@ class InstrumentDatabase(object):
     Handles saving+loading information that should be stored permanently to avoid loading it again from Yahoo.
     The IB csvs do not give us the yahoo ticker name which we need for fetching prices. YahooSymbolScraper can fetch
     that information but it's slow.
+
+    Lookups are served from an in-memory index of all instruments, as they happen for every csv row. The index is
+    loaded with one query per table and dropped whenever we write to those tables.
     """
 
+    index = None
+
+    def get_index(self):
+        if self.index is None:
+            index = InstrumentIndex()
+            for alias in DBInstrumentAlias.select().order_by(DBInstrumentAlias.id):
+                index.aliases.setdefault(alias.instrument_id, []).append(alias.symbol)
+            for db_instrument in DBInstrument.select().order_by(DBInstrument.id):
+                index.add(db_instrument)
+            index.ignored = set(i.symbol_ib for i in DBInstrumentIgnored.select())
+            self.index = index
+        return self.index
+
+    def invalidate(self):
+        self.index = None
+
     def get(self, con_id):
-        return DBInstrument.get_or_none(con_id=con_id)
+        return self.get_index().by_con_id.get(con_id)
 
     def get_by_security_id(self, security_id):
-        return DBInstrument.get_or_none(security_id=security_id)
+        return self.get_index().by_security_id.get(security_id)
 
     def get_by_symbol_ib(self, symbol_ib, currency=None):
-        if currency:
-            db_instrument = DBInstrument.get_or_none(symbol_ib=symbol_ib, currency=currency)
-        else:
-            db_instrument = DBInstrument.get_or_none(symbol_ib=symbol_ib)
-        if not db_instrument:
-            db_instrument = DBInstrument.get_or_none(DBInstrument.symbols_ib_additional.contains(symbol_ib))
-        return db_instrument
+        index = self.get_index()
+        for db_instrument in index.by_symbol_ib.get(symbol_ib, []):
+            if not currency or db_instrument.currency == currency:
+                return db_instrument
+        for db_instrument in index.by_alias.get(symbol_ib, []):
+            if not currency or db_instrument.currency == currency:
+                return db_instrument
+        return None
+
+    def get_by_symbol_yahoo(self, symbol_yahoo):
+        return self.get_index().by_symbol_yahoo.get(symbol_yahoo)
+
+    def is_ignored(self, symbol_ib):
+        return symbol_ib in self.get_index().ignored
+
+    def get_aliases(self, instrument_filter):
+        """
+        All symbols IB may use in a csv for the instruments in the filter: the filter itself plus current and former IB
+        symbols of instruments matching it by IB, yahoo or former symbol. Lets parsers drop other rows early.
+        """
+        aliases = set(instrument_filter)
+        for db_instrument in self.get_index().by_con_id.values():
+            symbols = get_symbols(db_instrument)
+            if any(s in instrument_filter or extract_symbol(s) in instrument_filter for s in symbols):
+                aliases.update(symbols)
+        return aliases
 
     def add(self, instrument):
         """
         Add to database if not in it yet.
         """
-        db_instrument = DBInstrument.get_or_none(con_id=instrument.con_id)
-        if not db_instrument:
-            if not instrument.symbol_yahoo:
-                log.debug("Add to ignore list: {}".format(instrument.symbol_ib))
-                DBInstrumentIgnored(symbol_ib=instrument.symbol_ib).save()
-                return
-            log.debug("Add instrument to database: {}".format(instrument.symbol_ib))
-            DBInstrument(
-                name=instrument.name,
-                symbol_yahoo=instrument.symbol_yahoo,
-                symbol_ib=instrument.symbol_ib,
-                symbols_ib_additional=",".join(instrument.symbols_ib_additional),
-                security_id=instrument.security_id,
-                con_id=instrument.con_id,
-                currency=instrument.currency,
-            ).save()
+        db_writer.run(self._add, instrument)
+        self.invalidate()
+
+    def add_many(self, instruments):
+        """Add instruments created with save=False in one transaction."""
+        db_writer.run(lambda: [self._add(instrument) for instrument in instruments if instrument.is_new])
+        self.invalidate()
+
+    def _add(self, instrument):
+        if self.get(instrument.con_id):
+            return
+        if not instrument.symbol_yahoo:
+            log.debug("Add to ignore list: {}".format(instrument.symbol_ib))
+            DBInstrumentIgnored(symbol_ib=instrument.symbol_ib).save()
+            return
+        log.debug("Add instrument to database: {}".format(instrument.symbol_ib))
+        db_instrument = DBInstrument.create(
+            name=instrument.name,
+            symbol_yahoo=instrument.symbol_yahoo,
+            symbol_ib=instrument.symbol_ib,
+            security_id=instrument.security_id,
+            con_id=instrument.con_id,
+            currency=instrument.currency,
+        )
+        self.add_aliases(db_instrument, instrument.symbols_ib_additional)
 
     def update_symbols(self, db_instrument, symbols):
+        symbol_ib = db_instrument.symbol_ib
         if db_instrument.symbol_ib not in symbols:
             symbols.append(db_instrument.symbol_ib)
             if not symbols[0].endswith(".OLD"):
-                db_instrument.symbol_ib = symbols[0]
-        if db_instrument.symbols_ib_additional:
-            symbols = db_instrument.symbols_ib_additional.split(",") + symbols
-        symbols = set([s for s in symbols if not s == db_instrument.symbol_ib])
-        db_instrument.symbols_ib_additional = ",".join(symbols)
-        db_instrument.save()
+                symbol_ib = symbols[0]
+        aliases = set(get_symbols(db_instrument)[2:])
+        new_aliases = set(symbols) - aliases
+        new_aliases.discard(symbol_ib)
+        # Aliases are unique per currency, those of other instruments were already refused with a warning
+        by_alias = self.get_index().by_alias
+        new_aliases = set(
+            s for s in new_aliases if not any(i.currency == db_instrument.currency for i in by_alias.get(s, []))
+        )
+        if symbol_ib == db_instrument.symbol_ib and not new_aliases:
+            return  # Nothing new, which is the case for almost every line
+        db_writer.run(self._update_symbols, db_instrument, symbol_ib, new_aliases)
+        self.invalidate()
+
+    def _update_symbols(self, db_instrument, symbol_ib, new_aliases):
+        if symbol_ib != db_instrument.symbol_ib:
+            db_instrument.symbol_ib = symbol_ib
+            db_instrument.save()
+            DBInstrumentAlias.delete().where(
+                (DBInstrumentAlias.instrument == db_instrument) & (DBInstrumentAlias.symbol == symbol_ib)
+            ).execute()
+        self.add_aliases(db_instrument, new_aliases)
+
+    def add_aliases(self, db_instrument, symbols):
+        for symbol in symbols:
+            inserted = (
+                DBInstrumentAlias.insert(instrument=db_instrument, symbol=symbol, currency=db_instrument.currency)
+                .on_conflict_ignore()
+                .as_rowcount()
+                .execute()
+            )
+            if not inserted:
+                log.warning("{}: Alias {} already belongs to another instrument".format(db_instrument, symbol))
+
+
+class InstrumentIndex(object):
+    """Instruments from the database by each of the keys we look them up with."""
+
+    def __init__(self):
+        self.by_con_id = {}
+        self.by_security_id = {}
+        self.by_symbol_ib = {}
+        self.by_alias = {}
+        self.aliases = {}  # Alias symbols per instrument id
+        self.by_symbol_yahoo = {}
+        self.ignored = set()
+
+    def add(self, db_instrument):
+        self.by_con_id[db_instrument.con_id] = db_instrument
+        self.by_security_id.setdefault(db_instrument.security_id, db_instrument)
+        self.by_symbol_yahoo.setdefault(db_instrument.symbol_yahoo, db_instrument)
+        self.by_symbol_ib.setdefault(db_instrument.symbol_ib, []).append(db_instrument)
+        for alias in self.aliases.get(db_instrument.id, []):
+            self.by_alias.setdefault(alias, []).append(db_instrument)
 
 
 def ignore_instrument(con_id, symbols, instrument_filter, currency=None):
     assert con_id or symbols, "One of either must be given for db lookup"
-    if DBInstrumentIgnored.get_or_none(symbol_ib=symbols[0]):
+    if db.is_ignored(symbols[0]):
         return True
     ignored_symbols = config.get("ignored_symbols").split(",")
     if any([extract_symbol(s) in ignored_symbols for s in symbols]):
@@ -259,15 +390,18 @@ def ignore_instrument(con_id, symbols, instrument_filter, currency=None):
                 break
 
     if db_instrument:
-        symbols = [db_instrument.symbol_yahoo]
-        if db_instrument.symbols_ib_additional:
-            symbols += db_instrument.symbols_ib_additional.split(",")
+        symbols = get_symbols(db_instrument)[1:]
         symbols += [extract_symbol(s) for s in symbols]
         return not any([s in instrument_filter for s in set(symbols)])
 
     return True
 
 
+def get_symbols(db_instrument):
+    """IB symbol, yahoo symbol and former IB symbols of a database instrument, in that order."""
+    return [db_instrument.symbol_ib, db_instrument.symbol_yahoo] + db.get_index().aliases.get(db_instrument.id, [])
+
+
 def extract_symbol(symbol):
     """Remove suffixes like the exchange name, or .OLD"""
     if "." in symbol:
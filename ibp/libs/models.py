@@ -1,11 +1,31 @@
+import atexit
 import os
-
-from peewee import CharField, DateField, DateTimeField, FloatField, ForeignKeyField, Model, SqliteDatabase
+from concurrent.futures import Future
+from datetime import datetime
+from queue import Empty, Queue
+from threading import Lock, Thread, current_thread
+
+from peewee import (
+    CharField,
+    DateField,
+    DateTimeField,
+    FloatField,
+    ForeignKeyField,
+    IntegerField,
+    Model,
+    SqliteDatabase,
+    TextField,
+    fn,
+)
+
+from playhouse.migrate import SqliteMigrator, migrate
 
 from .config import config
+from .logging import log
 
 db_file = os.path.expanduser(config.get("db_file"))
-db = SqliteDatabase(db_file)
+# With WAL, reads go on while the writer thread commits
+db = SqliteDatabase(db_file, pragmas={"journal_mode": "wal", "synchronous": "normal", "cache_size": -16 * 1024})
 
 
 class BaseModel(Model):
@@ -17,17 +37,35 @@ class InstrumentIgnored(BaseModel):
     symbol_ib = CharField()
 
 
+class SchemaVersion(BaseModel):
+    """One row per migration applied to the database, see MIGRATIONS."""
+
+    version = IntegerField(unique=True)
+    applied = DateTimeField(default=datetime.now)
+
+
 class Instrument(BaseModel):
     name = CharField()
     symbol_ib = CharField()
     symbol_yahoo = CharField()
-    symbols_ib_additional = CharField()
     con_id = CharField(unique=True)
     security_id = CharField()  # CA03765K1049 is the same for 10E und APHA
     currency = CharField()
 
     def __repr__(self):
-        return "<Instrument: IB {} YA {} | {}>".format(self.symbol_ib, self.symbol_yahoo, self.symbols_ib_additional)
+        aliases = ",".join(a.symbol for a in self.aliases)
+        return "<Instrument: IB {} YA {} | {}>".format(self.symbol_ib, self.symbol_yahoo, aliases)
+
+
+class InstrumentAlias(BaseModel):
+    """Further symbols IB uses or used for an instrument, e.g. the one before a name change."""
+
+    instrument = ForeignKeyField(Instrument, backref="aliases", null=False, on_delete="CASCADE")
+    symbol = CharField(null=False)
+    currency = CharField(null=False)
+
+    class Meta:
+        indexes = ((("symbol", "currency"), True),)
 
 
 class Price(BaseModel):
@@ -43,4 +81,174 @@ class CurrencyRate(BaseModel):
     date = DateField(null=False)
 
 
-db.create_tables([InstrumentIgnored, Instrument, Price, CurrencyRate])
+class CSVFileSection(BaseModel):
+    """Lines of a csv file matching one of CSVReader's patterns. Valid as long as the file's fingerprint is the same."""
+
+    path = CharField(null=False)
+    pattern = CharField(null=False)
+    size = IntegerField(null=False)
+    mtime = FloatField(null=False)
+    digest = CharField(null=False)  # sha1 of the file content
+    lines = TextField(null=False)  # json list
+
+    class Meta:
+        indexes = ((("path", "pattern"), True),)
+
+
+class CSVFileIndex(BaseModel):
+    """Byte ranges of each section of a csv file, to read sections not cached yet without scanning the whole file."""
+
+    path = CharField(unique=True)
+    size = IntegerField(null=False)
+    mtime = FloatField(null=False)
+    digest = CharField(null=False)  # sha1 of the file content
+    sections = TextField(null=False)  # json, section name to list of [start, end] byte offsets
+
+
+class FailedLookup(BaseModel):
+    """A yahoo url that did not know the instrument we asked for, see FailedLookups."""
+
+    url = CharField(unique=True)
+    outcome = CharField(null=False)
+    timestamp = DateTimeField(default=datetime.now)
+
+
+def migrate_instrument_aliases():
+    """
+    Moves the comma-joined Instrument.symbols_ib_additional column of older databases into InstrumentAlias rows. That
+    column could only be searched with LIKE '%symbol%', which is slow and also finds symbols containing the searched
+    one.
+    """
+    if "symbols_ib_additional" not in [c.name for c in db.get_columns(Instrument._meta.table_name)]:
+        return
+    rows = db.execute_sql("SELECT id, symbols_ib_additional, currency FROM {}".format(Instrument._meta.table_name))
+    for instrument_id, symbols, currency in rows.fetchall():
+        for symbol in filter(None, (symbols or "").split(",")):
+            inserted = (
+                InstrumentAlias.insert(instrument=instrument_id, symbol=symbol, currency=currency)
+                .on_conflict_ignore()
+                .as_rowcount()
+                .execute()
+            )
+            if not inserted:
+                log.warning(
+                    "Instrument {}: Dropping alias {}, it already belongs to another instrument".format(
+                        instrument_id, symbol
+                    )
+                )
+    migrate(SqliteMigrator(db).drop_column(Instrument._meta.table_name, "symbols_ib_additional"))
+
+
+# Not in the models' Meta, as create_tables would create them before add_lookup_indexes runs
+LOOKUP_INDEXES = [
+    (Instrument, ("symbol_ib",)),
+    (Price, ("instrument_id", "datetime")),
+    (CurrencyRate, ("currency_a", "currency_b", "date")),
+]
+
+
+def add_lookup_indexes():
+    """Indexes for looking up prices by instrument and day, rates by currency pair and day and instruments by symbol."""
+    migrator = SqliteMigrator(db)
+    migrate(*(migrator.add_index(model._meta.table_name, columns) for model, columns in LOOKUP_INDEXES))
+
+
+# Applied in order, each one once. Only ever append to this list, the position is the schema version.
+MIGRATIONS = [migrate_instrument_aliases, add_lookup_indexes]
+TABLES = [
+    SchemaVersion,
+    InstrumentIgnored,
+    Instrument,
+    InstrumentAlias,
+    Price,
+    CurrencyRate,
+    CSVFileSection,
+    CSVFileIndex,
+    FailedLookup,
+]
+
+
+class DBWriter(object):
+    """
+    Runs all writes to the database in one thread, so threads don't wait for each other's locks. Writes queued while a
+    batch commits are committed together with the next one. Each write runs in a savepoint, a failing one only fails
+    its own future.
+    """
+
+    batch_size = 500
+
+    def __init__(self):
+        self.queue = Queue()
+        self.thread = None
+        self.lock = Lock()
+
+    def submit(self, function, *args, **kwargs):
+        """Queues function(*args, **kwargs), the returned future is done once the write is committed."""
+        if current_thread() is self.thread:  # Write within a write
+            future = Future()
+            future.set_result(function(*args, **kwargs))
+            return future
+        self.start()
+        future = Future()
+        self.queue.put((future, function, args, kwargs))
+        return future
+
+    def run(self, function, *args, **kwargs):
+        """Same as submit, but waits for the commit and returns the result of function."""
+        return self.submit(function, *args, **kwargs).result()
+
+    def flush(self):
+        """Waits until everything queued so far is committed."""
+        if self.thread:
+            self.run(lambda: None)
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.work, name="DBWriter", daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def work(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            results = []
+            try:
+                with db.atomic():
+                    for future, function, args, kwargs in batch:
+                        try:
+                            with db.atomic():
+                                results.append((future, function(*args, **kwargs), None))
+                        except Exception as e:
+                            results.append((future, None, e))
+            except Exception as e:  # The commit failed
+                results = [(future, None, e) for future, _, _, _ in batch]
+            for future, result, error in results:
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+
+db_writer = DBWriter()
+
+
+def get_schema_version():
+    return SchemaVersion.select(fn.MAX(SchemaVersion.version)).scalar() or 0
+
+
+def init_db():
+    """Creates missing tables and brings an existing database up to the latest schema version."""
+    db.create_tables(TABLES)
+    version = get_schema_version()
+    assert version <= len(MIGRATIONS), "Database {} is newer than this version of ibparser".format(db_file)
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        log.debug("Migrating database to schema version {}: {}".format(number, migration.__name__))
+        with db.atomic():
+            migration()
+            SchemaVersion.create(version=number)
@@ -1,12 +1,13 @@
 import os
 from datetime import date
+from threading import Lock
 
-from forex_python.converter import CurrencyRates
+from forex_python.converter import CurrencyRates, RatesNotAvailableError
 
 from .config import config
 from .constants import KNOWN_CURRENCIES
 from .logging import log
-from .models import CurrencyRate as DBCurrencyRate
+from .models import CurrencyRate as DBCurrencyRate, db_writer
 
 
 class Money(object):
@@ -79,34 +80,113 @@ def convert_currency(base_currency, destination_currency, amount):
     assert destination_currency in KNOWN_CURRENCIES, destination_currency
     converter = config.get("currency_converter")
     if converter == "gnu-units":
-        output = os.popen("units --terse -- {}{} {}".format(amount, base_currency, destination_currency)).read()
-        return float(output.strip())
+        return units_converter.convert(base_currency, destination_currency, amount)
     elif converter == "forex-python":
         return forex_converter.convert(base_currency, destination_currency, amount)
     raise RuntimeError("Unknown currency_converter. Should be either forex-python or gnu-units: {}".format(converter))
 
 
 class CachedCurrencyRates(CurrencyRates):
-    """Caches currency rates that have already been fetched for great speed up."""
+    """
+    Keeps the rates between all known currencies per day, loaded from the db with one query per day. Pairs not in the db
+    are triangulated through another currency, preferably the pivot. When that fails too, the rates of the pivot to
+    all currencies are fetched online with one request and stored in the db.
+    """
 
-    cache = {}
+    pivot = "EUR"
+    cache = {}  # date to {(currency a, currency b): rate}
+    lock = Lock()
 
-    def convert(self, base_cur, dest_cur, amount, given_date=date.today()):
+    def convert(self, base_cur, dest_cur, amount, given_date=None):
         assert base_cur, "We can't proceed w/o knowing the base currency."
         assert dest_cur, "We can't proceed w/o knowing the destination currency."
-        # Look in db:
-        db_rate = DBCurrencyRate.get_or_none(currency_a=base_cur, currency_b=dest_cur, date=given_date)
-        if db_rate:
-            return db_rate.rate * amount
-        db_rate = DBCurrencyRate.get_or_none(currency_a=dest_cur, currency_b=base_cur, date=given_date)
-        if db_rate:
-            return 1 / db_rate.rate
-
-        # Look it up online:
-        log.debug("Fetching rate: {}-{}".format(base_cur, dest_cur))
-        rate = super(CachedCurrencyRates, self).convert(base_cur, dest_cur, 1, given_date)
-        DBCurrencyRate(currency_a=base_cur, currency_b=dest_cur, rate=rate, date=given_date).save()
-        return rate * amount
+        return self.get_rate(base_cur, dest_cur, given_date or date.today()) * amount
+
+    def get_rate(self, base_cur, dest_cur, given_date=None):
+        if base_cur == dest_cur:
+            return 1.0
+        given_date = given_date or date.today()
+        rates = self.cache.get(given_date)
+        rate = rates.get((base_cur, dest_cur)) if rates else None
+        if rate is None:
+            with self.lock:
+                rates = self._get_rates(given_date)
+                rate = self._triangulate(rates, base_cur, dest_cur)
+                if rate is None:
+                    self._fetch_rates(rates, given_date)
+                    rate = self._triangulate(rates, base_cur, dest_cur)
+                if rate is None:
+                    raise RatesNotAvailableError(
+                        "Currency Rate {} => {} not available for Date {}".format(base_cur, dest_cur, given_date)
+                    )
+                rates[(base_cur, dest_cur)] = rate
+        return rate
+
+    def _get_rates(self, given_date):
+        """Rates of the day from the db, the first stored one for each pair, and their inverse where that is missing"""
+        if given_date not in self.cache:
+            db_rates = (
+                DBCurrencyRate.select()
+                .where(
+                    (DBCurrencyRate.date == given_date)
+                    & DBCurrencyRate.currency_a.in_(KNOWN_CURRENCIES)
+                    & DBCurrencyRate.currency_b.in_(KNOWN_CURRENCIES)
+                )
+                .order_by(DBCurrencyRate.id)
+            )
+            rates = {}
+            for db_rate in db_rates:
+                rates.setdefault((db_rate.currency_a, db_rate.currency_b), db_rate.rate)
+            for (currency_a, currency_b), rate in list(rates.items()):
+                rates.setdefault((currency_b, currency_a), 1 / rate)
+            log.debug("Loaded {} currency rates of {}".format(len(rates), given_date))
+            self.cache[given_date] = rates
+        return self.cache[given_date]
+
+    def _triangulate(self, rates, base_cur, dest_cur):
+        rate = rates.get((base_cur, dest_cur))
+        if rate is not None:
+            return rate
+        for currency in [self.pivot] + sorted(KNOWN_CURRENCIES):
+            if (base_cur, currency) in rates and (currency, dest_cur) in rates:
+                return rates[(base_cur, currency)] * rates[(currency, dest_cur)]
+        return None
+
+    def _fetch_rates(self, rates, given_date):
+        """Fetches the rates of the pivot to all currencies with one request, adding the ones missing to rates and db"""
+        log.debug("Fetching rates: {} {}".format(self.pivot, given_date))
+        fetched = super(CachedCurrencyRates, self).get_rates(self.pivot, given_date)
+        rows = []
+        for currency, rate in fetched.items():
+            if currency in KNOWN_CURRENCIES and currency != self.pivot and (self.pivot, currency) not in rates:
+                rates[(self.pivot, currency)] = float(rate)
+                rates.setdefault((currency, self.pivot), 1 / float(rate))
+                rows.append({"currency_a": self.pivot, "currency_b": currency, "rate": float(rate), "date": given_date})
+        if rows:
+            db_writer.submit(DBCurrencyRate.insert_many(rows).execute)
+
+
+class UnitsCurrencyRates(object):
+    """Asks GNU units once per currency pair for its rate and keeps it, as starting units is slower than converting."""
+
+    def __init__(self):
+        self.rates = {}  # (base currency, destination currency) to rate
+
+    def get_rate(self, base_currency, destination_currency):
+        rate = self.rates.get((base_currency, destination_currency))
+        if rate is None:
+            log.debug("Asking units for rate: {}-{}".format(base_currency, destination_currency))
+            output = os.popen(
+                "units --terse --output-format %.15g -- 1{} {}".format(base_currency, destination_currency)
+            ).read()
+            rate = float(output.strip())
+            self.rates[(base_currency, destination_currency)] = rate
+            self.rates[(destination_currency, base_currency)] = 1 / rate
+        return rate
+
+    def convert(self, base_currency, destination_currency, amount):
+        return self.get_rate(base_currency, destination_currency) * amount
 
 
 forex_converter = CachedCurrencyRates()
+units_converter = UnitsCurrencyRates()
@@ -1,13 +1,49 @@
+import csv
 import glob
+import hashlib
+import json
+import mmap
+import os
 import re
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from operator import itemgetter
 from os import path
 
+from peewee import chunked
+
+from .config import config
 from .logging import log
+from .models import CSVFileIndex, CSVFileSection, db_writer
+
+ENGLISH_MONTHS = [
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+]
+
+
+def get_section_key(line):
+    """Returns the first two csv fields of a line, e.g. 'Trades,Data' which identify section and row type."""
+    return line[: line.find(",", line.find(",") + 1)]
 
 
 class CSVReader(object):
-    """Base class to get relevant parts from IB csv files"""
+    """
+    Base class to get relevant parts from IB csv files. Lines are streamed file by file from generators, so memory use
+    does not grow with the number of statements.
+    """
 
     money_move_pattern = r"^Deposits & Withdrawals,Data,[A-Z]{3}"
     dividend_pattern = r"^Dividends,Data,[A-Z]{3}"
@@ -18,8 +54,9 @@ class CSVReader(object):
     position_pattern = r"Long Open Positions,Data,Summary,Stocks"
 
     portfolio_pattern = r"Account Information,Data,Base Currency|Net Asset Value,Data,Total"
+    period_pattern = r"^Statement,Data,Period"  # Always read, see get_files_in_period
     patterns = [dividend_pattern, instrument_pattern, transaction_pattern, money_move_pattern, corporate_action_pattern]
-    relevant_lines = defaultdict(list)
+    files_per_batch = 64  # Files looked up in the cache per query and handed to the process pool at once
 
     def __init__(self, csv_folder=None, files=None, patterns=None):
         log.debug("{}.__init__".format(self.__class__.__name__))
@@ -29,40 +66,397 @@ class CSVReader(object):
 
         assert files, "Not any matching files found: {}".format(csv_folder)
         self.files = sorted(files)
-        if patterns:
-            self.patterns = patterns
-        self.get_relevant_lines()
-
-    def get_relevant_lines(self):
-        lines = []
-        log.debug("Search lines {}".format(", ".join(self.patterns)))
-        for csv_filename in self.files:
-            log.debug("In file {}".format(csv_filename))
-            with open(csv_filename, "r") as csv_file:
-                for line in csv_file.readlines():
-                    for pattern in self.patterns:
-                        if re.match(pattern, line):
-                            self.relevant_lines[pattern].append(line)
-        return lines
+        self.duplicate_lines = Counter()
+        self.indexes = None
+        self.patterns = list(patterns or self.patterns)
+        if self.period_pattern not in self.patterns:
+            self.patterns.append(self.period_pattern)
+
+    def get_sections(self, pattern, date_delta=None):
+        """
+        Yields (csv_filename, header, lines) for each block of lines matching pattern, file by file in order. header is
+        the section header line describing the columns of the lines, or None if the file had none. With a date_delta
+        (see parse_date_delta) only files with a statement period overlapping it are read, so only pass it for sections
+        that list what happened within the statement period.
+
+        Daily and monthly statements overlap, so lines an earlier file already had are skipped. Repeated lines within
+        one file are kept though, as IB lists e.g. two identical dividend payments on the same day twice.
+        """
+        log.debug("Search lines {}".format(pattern))
+        seen_lines = set()  # Digests instead of the lines themselves to keep this small
+        for csv_filename, file_lines in self.get_file_lines(pattern, self.get_files_in_period(date_delta)):
+            header = None
+            lines = []
+            file_digests = set()
+            for line in file_lines:
+                if get_section_key(line).endswith(",Header"):
+                    if lines:
+                        yield csv_filename, header, lines
+                        lines = []
+                    header = line
+                    continue
+                line_digest = hashlib.blake2b(line.encode(), digest_size=16).digest()
+                if line_digest in seen_lines:
+                    self.duplicate_lines[pattern] += 1
+                else:
+                    file_digests.add(line_digest)
+                    lines.append(line)
+            if lines:
+                yield csv_filename, header, lines
+            seen_lines |= file_digests
+        log.debug("Dropped {} duplicate lines of {}".format(self.duplicate_lines[pattern], pattern))
+
+    def get_lines(self, pattern, date_delta=None):
+        for _, _, lines in self.get_sections(pattern, date_delta):
+            yield from lines
+
+    def get_files_in_period(self, date_delta):
+        """
+        Files whose statement period overlaps date_delta (see parse_date_delta), plus those not stating their period.
+        The period line is extracted and cached like any other section, so after the first run this costs one cached
+        line per file instead of reading all sections of all files.
+        """
+        if not date_delta:
+            return self.files
+        start, end = (date_delta, datetime.max) if isinstance(date_delta, datetime) else date_delta
+        files = []
+        for csv_filename, lines in self.get_file_lines(self.period_pattern, self.files):
+            period = parse_statement_period(lines)
+            if not period or (period[0] <= end and start <= period[1]):
+                files.append(csv_filename)
+        log.debug("{} of {} files within {}".format(len(files), len(self.files), date_delta))
+        return files
+
+    def get_file_lines(self, pattern, files):
+        """
+        Yields (csv_filename, lines) with the lines of each of the files matching pattern, including the section's
+        header lines. IB never changes a statement once delivered, so extracted lines are stored in the db and read from
+        there as long as the file's size and mtime, or else its content, stay the same.
+
+        A file seen for the first time is scanned once for all of the reader's patterns, which also records the byte
+        ranges of every section in the file. Patterns asked for later only read their sections' ranges.
+        """
+        cached = {
+            s.path: s
+            for s in CSVFileSection.select(
+                CSVFileSection.path, CSVFileSection.size, CSVFileSection.mtime, CSVFileSection.digest
+            ).where(CSVFileSection.pattern == pattern)
+        }
+        indexes = self.get_indexes()
+        workers = config.getint("csv_workers", fallback=0)
+        pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            for files in chunked(files, self.files_per_batch):
+                fresh = []
+                to_scan = []
+                for csv_filename in files:
+                    stat = os.stat(csv_filename)
+                    section = cached.get(csv_filename)
+                    index = indexes.get(csv_filename)
+                    if is_fresh(section, stat):
+                        fresh.append(csv_filename)
+                    elif is_fresh(index, stat):
+                        to_scan.append((csv_filename, stat, None, get_ranges(index, pattern)))
+                    else:
+                        fingerprint = index or section
+                        known_digest = fingerprint.digest if fingerprint and fingerprint.size == stat.st_size else None
+                        to_scan.append((csv_filename, stat, known_digest, None))
+
+                scanned = {}
+                new_sections = []
+                new_indexes = []
+                for (csv_filename, stat, _, ranges), (digest, file_lines, sections) in zip(
+                    to_scan, self.scan(to_scan, pattern, pool)
+                ):
+                    index = indexes.get(csv_filename)
+                    if file_lines is None:
+                        # Only touched, e.g. copied over from another machine. Sections extracted from an older
+                        # content of the file keep their mtime, so they are never taken for fresh.
+                        for model in (CSVFileSection, CSVFileIndex):
+                            db_writer.submit(
+                                model.update(mtime=stat.st_mtime)
+                                .where((model.path == csv_filename) & (model.digest == digest))
+                                .execute
+                            )
+                        if index:
+                            index.mtime = stat.st_mtime
+                        if csv_filename in cached and cached[csv_filename].digest == digest:
+                            fresh.append(csv_filename)
+                            continue
+                        digest, file_lines, _ = scan_file(csv_filename, [pattern], ranges=get_ranges(index, pattern))
+                    if sections is not None:
+                        new_indexes.append(
+                            {
+                                "path": csv_filename,
+                                "size": stat.st_size,
+                                "mtime": stat.st_mtime,
+                                "digest": digest,
+                                "sections": json.dumps(sections),
+                            }
+                        )
+                        indexes[csv_filename] = CSVFileIndex(**new_indexes[-1])
+                    scanned[csv_filename] = file_lines[pattern]
+                    new_sections += [
+                        {
+                            "path": csv_filename,
+                            "pattern": p,
+                            "size": stat.st_size,
+                            "mtime": stat.st_mtime,
+                            "digest": digest or indexes[csv_filename].digest,
+                            "lines": json.dumps(lines),
+                        }
+                        for p, lines in file_lines.items()
+                    ]
+                for batch in chunked(new_sections, 100):
+                    db_writer.submit(CSVFileSection.replace_many(batch).execute)
+                for batch in chunked(new_indexes, 100):
+                    db_writer.submit(CSVFileIndex.replace_many(batch).execute)
+                db_writer.flush()
+
+                cached_lines = dict(
+                    CSVFileSection.select(CSVFileSection.path, CSVFileSection.lines)
+                    .where((CSVFileSection.pattern == pattern) & (CSVFileSection.path.in_(fresh)))
+                    .tuples()
+                )
+                for csv_filename in files:
+                    if csv_filename in scanned:
+                        yield csv_filename, scanned[csv_filename]
+                    else:
+                        yield csv_filename, json.loads(cached_lines[csv_filename])
+        finally:
+            if pool:
+                pool.shutdown()
+
+    def get_indexes(self):
+        """Section byte ranges per file, loaded once per reader."""
+        if self.indexes is None:
+            files = set(self.files)
+            self.indexes = {i.path: i for i in CSVFileIndex.select() if i.path in files}
+        return self.indexes
+
+    def scan(self, to_scan, pattern, pool=None):
+        """
+        Scans files not found in the cache, either entirely for all of the reader's patterns or only the known byte
+        ranges for the given pattern. Spreads them over a process pool if 'csv_workers' is configured, as with thousands
+        of statements this is CPU-bound. Results come back in the order of to_scan either way.
+        """
+        arguments = [
+            (csv_filename, [pattern] if ranges is not None else self.patterns, known_digest, ranges)
+            for csv_filename, _, known_digest, ranges in to_scan
+        ]
+        if not pool or len(arguments) < 2:
+            return [scan_file(*a) for a in arguments]
+        log.debug("Scanning {} files in a process pool".format(len(arguments)))
+        return pool.map(scan_file, *zip(*arguments), chunksize=4)
 
     def get_instrument_lines(self):
-        return self.relevant_lines[self.instrument_pattern]
+        return self.get_lines(self.instrument_pattern)
+
+    def get_dividend_lines(self, date_delta=None):
+        return self.get_lines(self.dividend_pattern, date_delta)
 
-    def get_dividend_lines(self):
-        return self.relevant_lines[self.dividend_pattern]
+    def get_dividend_sections(self, date_delta=None):
+        return self.get_sections(self.dividend_pattern, date_delta)
 
-    def get_transaction_lines(self):
-        return self.relevant_lines[self.transaction_pattern]
+    def get_transaction_lines(self, date_delta=None):
+        return self.get_lines(self.transaction_pattern, date_delta)
 
-    def get_money_move_lines(self):
-        return self.relevant_lines[self.money_move_pattern]
+    def get_transaction_sections(self, date_delta=None):
+        return self.get_sections(self.transaction_pattern, date_delta)
+
+    def get_money_move_lines(self, date_delta=None):
+        return self.get_lines(self.money_move_pattern, date_delta)
 
     def get_corporate_action_lines(self):
         """Splits and merges"""
-        return self.relevant_lines[self.corporate_action_pattern]
+        return self.get_lines(self.corporate_action_pattern)
 
     def get_position_lines(self):
-        return self.relevant_lines[self.position_pattern]
+        return self.get_lines(self.position_pattern)
 
     def get_portfolio_lines(self):
-        return self.relevant_lines[self.portfolio_pattern]
+        return self.get_lines(self.portfolio_pattern)
+
+
+def scan_file(csv_filename, patterns, known_digest=None, ranges=None):
+    """
+    Sorts the lines of one file into lists per pattern. Header lines of the pattern's section are kept in the list to
+    know the columns of the lines following them. Returns the sha1 of the file content, those lists and the byte ranges
+    of every section in the file. The lists are None if the content still matches known_digest.
+
+    If ranges (list of [start, end] byte offsets) are given only those parts of the file are read, and neither sha1 nor
+    section ranges are returned.
+
+    The file is memory-mapped and only lines of a section we are interested in get decoded.
+    """
+    log.debug("In file {}".format(csv_filename))
+    file_lines = {pattern: [] for pattern in patterns}
+    dispatch = compile_dispatch(tuple(patterns))
+    if ranges == []:
+        return None, file_lines, None
+    with open(csv_filename, "rb") as csv_file:
+        if os.fstat(csv_file.fileno()).st_size == 0:  # Can't mmap an empty file
+            digest = hashlib.sha1().hexdigest()
+            if digest == known_digest:
+                return digest, None, None
+            return digest, file_lines, {}
+        with mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            if ranges:
+                for start, end in ranges:
+                    content.seek(start)
+                    while content.tell() < end:
+                        line = content.readline()
+                        candidates = dispatch.get(line[: line.find(b",", line.find(b",") + 1)])
+                        if candidates:
+                            add_line(line, candidates, file_lines)
+                return None, file_lines, None
+
+            digest = hashlib.sha1(content).hexdigest()
+            if digest == known_digest:
+                return digest, None, None
+
+            sections = defaultdict(list)
+            section_range = None
+            previous_section = None
+            position = 0
+            for line in iter(content.readline, b""):
+                section = line[: line.find(b",")]
+                if section != previous_section:
+                    section_range = [position, None]
+                    sections[section.decode(errors="replace")].append(section_range)
+                    previous_section = section
+                position += len(line)
+                section_range[1] = position
+
+                candidates = dispatch.get(line[: line.find(b",", line.find(b",") + 1)])
+                if not candidates:
+                    continue  # Section we are not interested in
+                add_line(line, candidates, file_lines)
+    return digest, file_lines, dict(sections)
+
+
+def add_line(line, candidates, file_lines):
+    """Decodes the line and adds it to the lists of the candidate patterns it matches."""
+    line = line.decode()
+    if line.endswith("\r\n"):
+        line = line[:-2] + "\n"
+    for pattern, regex in candidates:
+        if regex is None or regex.match(line):
+            file_lines[pattern].append(line)
+
+
+def parse_statement_period(lines):
+    """
+    First and last moment of the period a statement covers, from a line like
+    Statement,Data,Period,"January 1, 2021 - December 31, 2021" or Statement,Data,Period,"January 4, 2021"
+    """
+    for row in csv.reader(lines):
+        if row[:3] != ["Statement", "Data", "Period"]:
+            continue
+        first, _, last = row[3].partition(" - ")
+        try:
+            first = parse_english_date(first)
+            last = parse_english_date(last) if last else first
+        except ValueError:
+            log.warning("Unknown statement period: {}".format(row[3]))
+            return None
+        return first, last.replace(hour=23, minute=59, second=59, microsecond=999)
+    return None
+
+
+def parse_english_date(text):
+    """'January 4, 2021' to datetime. strptime's %B would depend on the user's locale."""
+    month, day, year = text.replace(",", " ").split()
+    return datetime(int(year), ENGLISH_MONTHS.index(month) + 1, int(day))
+
+
+def is_fresh(fingerprint, stat):
+    """Tells if a cache entry was made from the file as it is now."""
+    return fingerprint is not None and fingerprint.size == stat.st_size and fingerprint.mtime == stat.st_mtime
+
+
+def get_ranges(index, pattern):
+    """Byte ranges of the sections of a pattern in the file, in file order."""
+    sections = json.loads(index.sections)
+    names = set(alternative.lstrip("^").split(",")[0] for alternative in pattern.split("|"))
+    return sorted(r for name in names for r in sections.get(name, []))
+
+
+@lru_cache(maxsize=None)
+def compile_dispatch(patterns):
+    """
+    Maps the section key (see get_section_key, as bytes) of every pattern to the compiled patterns that can match lines
+    of that section. The header key of the section maps to None instead of a regex as every header line is relevant.
+    Expects the first two csv fields of each pattern (or each alternative of it) to be literal text.
+    """
+    dispatch = defaultdict(list)
+    for pattern in patterns:
+        regex = re.compile(pattern)
+        for alternative in pattern.split("|"):
+            section, row_type = alternative.lstrip("^").split(",")[:2]
+            dispatch["{},{}".format(section, row_type).encode()].append((pattern, regex))
+            dispatch["{},Header".format(section).encode()].append((pattern, None))
+    return dict(dispatch)
+
+
+@lru_cache(maxsize=None)
+def compile_schema(header, row_type, titles, optional=()):
+    """
+    Builds a function turning a data row (list of csv fields) into a row_type namedtuple, by looking up the index of
+    each field's column in the section header line once. titles holds the possible column titles per field of
+    row_type. Returns None if the header lacks a column not listed in optional, fields in optional are None then.
+    """
+    columns = get_column_indices(header, row_type, titles)
+    if columns is None or any(f not in columns and f not in optional for f in row_type._fields):
+        return None
+    indices = [columns.get(f) for f in row_type._fields]
+
+    if None not in indices:
+        getter = itemgetter(*indices)
+
+        def extract(row):
+            return row_type._make(getter(row))
+
+    else:
+
+        def extract(row):
+            return row_type._make([None if i is None else row[i] for i in indices])
+
+    return extract
+
+
+@lru_cache(maxsize=None)
+def get_column_indices(header, row_type, titles):
+    """Maps each field of row_type found in the header line to its column index, see compile_schema."""
+    if not header:
+        return None
+    header = next(csv.reader([header]))
+    columns = {}
+    for field, alternatives in zip(row_type._fields, titles):
+        index = next((header.index(t) for t in alternatives if t in header), None)
+        if index is not None:
+            columns[field] = index
+    return columns
+
+
+def filter_lines(lines, header, row_type, titles, conditions):
+    """
+    Drops lines before they are csv-parsed and turned into objects. conditions maps fields of row_type to a function
+    telling if a value of that column should be kept. Fields up to those columns rarely have quotes, so a plain split
+    usually does, a line with quotes there is csv-parsed. Without a usable header all lines are kept.
+    """
+    columns = get_column_indices(header, row_type, titles)
+    if not conditions or not columns:
+        return lines
+    checks = [(columns[field], keep) for field, keep in conditions.items() if field in columns]
+    if not checks:
+        return lines
+    last = max(index for index, _ in checks)
+    kept = []
+    for line in lines:
+        fields = line.split(",", last + 1)
+        if any('"' in f for f in fields[: last + 1]):
+            fields = next(csv.reader([line]))
+        if len(fields) <= last or all(keep(fields[index]) for index, keep in checks):
+            kept.append(line)
+    return kept
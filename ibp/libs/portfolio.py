@@ -42,7 +42,7 @@ class Portfolio(object):
         self.filter_currency = filter_currency
         self.machine_readable = machine_readable
         self.sort_order = sort_order or "name"
-        self.position_lines = reader.get_position_lines()
+        self.position_lines = list(reader.get_position_lines())
         self.get_portfolio_metadata()
         self.total_stock_value, self.base_currency = self.get_portfolio_metadata()
 
@@ -132,7 +132,7 @@ class Portfolio(object):
         Determine total stock value (needed for calculating weight of each position) and base currency (currency IB
         uses for unrealized profits, fees etc.)
         """
-        metadata = self.reader.get_portfolio_lines()
+        metadata = list(self.reader.get_portfolio_lines())
         base_currency = metadata[0].split(",").pop().strip()
         nav_total = Money(float(metadata[1].split(",")[6]), base_currency)
         return nav_total, base_currency
@@ -0,0 +1,142 @@
+import json
+import os
+from threading import Lock, get_ident
+
+import numpy as np
+from peewee import fn
+
+from .config import config
+from .logging import log
+from .models import Price as DBPrice
+
+
+class PriceSeries(object):
+    """Close prices of one instrument as sorted numpy arrays of days and closes, at most one close per day."""
+
+    def __init__(self, dates, closes):
+        self.dates = dates  # datetime64[D]
+        self.closes = closes  # float64
+
+    def __len__(self):
+        return len(self.dates)
+
+    def get(self, day):
+        """Close of the given date or datetime, None if there is none."""
+        day = np.datetime64(day, "D")
+        i = np.searchsorted(self.dates, day)
+        if i < len(self.dates) and self.dates[i] == day:
+            return float(self.closes[i])
+        return None
+
+    def get_as_of(self, day, days_before=None):
+        """Close of the given day or the last one before it, but at most days_before days before it."""
+        day = np.datetime64(day, "D")
+        i = np.searchsorted(self.dates, day, side="right") - 1
+        if i < 0 or (days_before is not None and day - self.dates[i] > np.timedelta64(days_before, "D")):
+            return None
+        return float(self.closes[i])
+
+    def get_range(self, start, end):
+        """Days and closes from start to end (both included) as read only views, without copying."""
+        i = np.searchsorted(self.dates, np.datetime64(start, "D"))
+        j = np.searchsorted(self.dates, np.datetime64(end, "D"), side="right")
+        return self.dates[i:j], self.closes[i:j]
+
+
+class PriceSeriesStore(object):
+    """
+    Keeps the prices of the database as one PriceSeries per instrument. The series are saved as .npy files in
+    price_series_path and memory-mapped when loaded. They are rebuilt from the database with one query when prices
+    were added to it since, which is noticed by comparing the number of prices and the highest price id.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.series = {}  # Instrument id to PriceSeries
+        self.versions = None  # Instrument id to (count, highest id) of the prices in the saved files
+        self.locks = {}  # Instrument id to the lock held while loading its series
+        self.lock = Lock()  # For self.locks and self.versions
+
+    def get(self, db_instrument):
+        series = self.series.get(db_instrument.id)
+        if series is None:
+            with self._get_lock(db_instrument.id):  # Others only wait for loading the same instrument
+                series = self.series.get(db_instrument.id)
+                if series is None:
+                    series = self.series[db_instrument.id] = self._load(db_instrument.id)
+        return series
+
+    def invalidate(self, db_instrument):
+        """To be called after adding prices of the instrument to the database."""
+        self.series.pop(db_instrument.id, None)
+
+    def _get_lock(self, instrument_id):
+        with self.lock:
+            return self.locks.setdefault(instrument_id, Lock())
+
+    def _load(self, instrument_id):
+        count, max_id = (
+            DBPrice.select(fn.COUNT(DBPrice.id), fn.MAX(DBPrice.id))
+            .where(DBPrice.instrument == instrument_id)
+            .scalar(as_tuple=True)
+        )
+        with self.lock:
+            saved_version = self._get_versions().get(str(instrument_id))
+        if saved_version == [count, max_id]:
+            try:
+                return PriceSeries(*(np.load(f, mmap_mode="r") for f in self._get_file_names(instrument_id)))
+            except (FileNotFoundError, ValueError):
+                log.debug("Price series of instrument {} unreadable, rebuilding it".format(instrument_id))
+        series, version = self._build(instrument_id)
+        self._save(instrument_id, series, version)
+        return series
+
+    def _build(self, instrument_id):
+        """
+        The series of the instrument and its version. The version is taken from the rows read, as the writer thread may
+        have added prices since the version was checked.
+        """
+        rows = list(
+            DBPrice.select(DBPrice.id, DBPrice.datetime, DBPrice.price)
+            .where(DBPrice.instrument == instrument_id)
+            .order_by(DBPrice.datetime)
+            .tuples()
+        )
+        ids, date_times, closes = zip(*rows) if rows else ((), (), ())
+        dates = np.array(date_times, dtype="datetime64[D]")
+        closes = np.array(closes, dtype="float64")
+        # Prices are sorted by time, so the last one of each day is the latest
+        last_of_day = np.append(dates[1:] != dates[:-1], True) if len(dates) else np.zeros(0, dtype=bool)
+        log.debug("Price series of instrument {}: {} days".format(instrument_id, last_of_day.sum()))
+        return PriceSeries(dates[last_of_day], closes[last_of_day]), [len(rows), max(ids, default=None)]
+
+    def _save(self, instrument_id, series, version):
+        os.makedirs(self.path, exist_ok=True)
+        for file_name, array in zip(self._get_file_names(instrument_id), (series.dates, series.closes)):
+            temp_file_name = "{}.{}.npy".format(file_name, get_ident())  # Readers must never see a partly written file
+            np.save(temp_file_name, array)
+            os.replace(temp_file_name, file_name)
+        with self.lock:
+            self._get_versions()[str(instrument_id)] = version
+            temp_file_name = "{}.{}".format(self._get_versions_file_name(), get_ident())
+            with open(temp_file_name, "w") as f:
+                json.dump(self.versions, f)
+            os.replace(temp_file_name, self._get_versions_file_name())
+
+    def _get_versions(self):
+        if self.versions is None:
+            try:
+                with open(self._get_versions_file_name()) as f:
+                    self.versions = json.load(f)
+            except (FileNotFoundError, ValueError):
+                self.versions = {}
+        return self.versions
+
+    def _get_versions_file_name(self):
+        return os.path.join(self.path, "versions.json")
+
+    def _get_file_names(self, instrument_id):
+        return [os.path.join(self.path, "{}.{}.npy".format(instrument_id, name)) for name in ("dates", "closes")]
+
+
+price_series = PriceSeriesStore(config.get("price_series_path", fallback="~/.cache/ibparser/prices/"))
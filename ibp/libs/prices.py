@@ -1,12 +1,18 @@
 from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime, timedelta
+from datetime import datetime, time, timedelta
+from io import StringIO
+from threading import Lock
 
+import pandas as pd
 from yahoo_historical import Fetcher
 
 from .config import config
+from .http_client import http_client
 from .logging import log
-from .models import Price as DBPrice
+from .models import Price as DBPrice, db_writer
 from .money import Money
+from .price_series import price_series
+from .trading_calendar import get_last_trading_day
 
 
 class PriceService(object):
@@ -20,28 +26,19 @@ class PriceService(object):
         """Return price for given date or stored date"""
         assert self.instrument.currency, "Don't have currency for {}".format(self.instrument)
         date_time = date_time or datetime.now()
-        if date_time.weekday() == 6:
-            date_time -= timedelta(days=1)
+        day = get_last_trading_day(self.instrument.symbol_yahoo, date_time.date())
+        if day != date_time.date():
+            date_time = datetime.combine(day, time())  # Exchange closed, the last close before counts
         price = self._get_from_database(date_time) or self._get_from_yahoo(date_time, failed_tries)
         return Money(price, self.instrument.currency)
 
-    def _get_from_database(self, date_time):
-        """Return most recent price for given day from db"""
-        start = date_time.replace(hour=0, minute=0, second=0, microsecond=0)
-        end = date_time.replace(hour=23, minute=59, second=59, microsecond=999)
-        prices = (
-            DBPrice.select()
-            .where(
-                (DBPrice.instrument == self.instrument._db_instrument)
-                & (DBPrice.datetime > start)
-                & (DBPrice.datetime < end)
-            )
-            .order_by(DBPrice.datetime.desc())
-            .limit(1)
-        )
-        if prices:
-            return prices.first().price
-        return None
+    def _get_from_database(self, date_time, days_before=0):
+        """Return most recent price for given day from db, or for up to days_before days before it"""
+        return price_series.get(self.instrument._db_instrument).get_as_of(date_time, days_before)
+
+    def get_range(self, start, end):
+        """Days and close prices known from start to end (both included) as numpy arrays, e.g. for charts"""
+        return price_series.get(self.instrument._db_instrument).get_range(start, end)
 
     def _get_from_yahoo(self, date_time, failed_tries=0):
         """Fetch close price of instrument on given date from yahoo"""
@@ -52,36 +49,94 @@ class PriceService(object):
                 )
             )
             return 0.001
-        log.debug("{}: Fetching {}".format(self.instrument.symbol_yahoo, date_time))
-        start = round(date_time.timestamp())
-        end = round((date_time + timedelta(days=1)).timestamp())
-        try:
-            data = Fetcher(self.instrument.symbol_yahoo, start, end)
-        except UnboundLocalError:
+        days = config.getint("price_fetch_days", fallback=7)
+        day = date_time.replace(hour=0, minute=0, second=0, microsecond=0)
+        # Days around the one we need, as further lookups for neighbouring days are likely
+        self.fetch(day - timedelta(days=days), min(day + timedelta(days=days), datetime.now()))
+        price_as_float = self._get_from_database(date_time)
+        if price_as_float is not None:
+            return price_as_float
+        # A holiday missing in our trading calendar, or today before yahoo has a price. The last close before is not
+        # stored for the day, as it would show up as a quote of its own, e.g. in get_range.
+        price_as_float = self._get_from_database(date_time, days_before=days)
+        if price_as_float is None:
             log.warning("Failed to fetch price: {} {}".format(self.instrument.symbol_yahoo, date_time))
-            return self.get(date_time - timedelta(days=1), failed_tries=failed_tries + 1).as_float
-
-        try:
-            price_as_float = data.get_historical().values[0][1]
-        except IndexError:
-            log.warning("Failed to fetch price: {} {}".format(self.instrument.symbol_yahoo, date_time))
-            price_as_float = self.get(date_time - timedelta(days=1), failed_tries=failed_tries + 1).as_float
-        self._write_to_database(price_as_float, date_time)
+            return self.get(day - timedelta(days=days + 1), failed_tries=failed_tries + 1).as_float
         return price_as_float
 
-    def _write_to_database(self, price_as_float, date_time):
-        DBPrice.get_or_create(instrument=self.instrument._db_instrument, price=price_as_float, datetime=date_time)
+    def fetch(self, start, end):
+        """
+        Fetches prices of all days from start to end (both included) with one request to yahoo and stores the ones not
+        in the database yet. Returns them as sorted list of (datetime, price).
+        """
+        log.debug("{}: Fetching {} to {}".format(self.instrument.symbol_yahoo, start.date(), end.date()))
+        start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = end.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        data = get_historical(self.instrument.symbol_yahoo, round(start.timestamp()), round(end.timestamp()))
+        if data.empty:
+            return []
+        prices = sorted(
+            (datetime.strptime(day, "%Y-%m-%d"), float(close))
+            for day, close in zip(data["Date"], data["Close"])
+            if pd.notna(close)
+        )
+        self._write_many_to_database(prices)
+        return prices
+
+    def _write_many_to_database(self, prices):
+        """Inserts (datetime, price) tuples for days that have no price in the database yet."""
+        if prices:
+            db_writer.run(self._insert_prices, prices)
+            price_series.invalidate(self.instrument._db_instrument)
+
+    def _insert_prices(self, prices):
+        instrument = self.instrument._db_instrument
+        known = DBPrice.select(DBPrice.datetime).where(
+            (DBPrice.instrument == instrument)
+            & (DBPrice.datetime >= prices[0][0])
+            & (DBPrice.datetime < prices[-1][0] + timedelta(days=1))
+        )
+        known_days = set(p.datetime.date() for p in known)
+        rows = [
+            {"instrument": instrument, "price": price, "datetime": d}
+            for d, price in prices
+            if d.date() not in known_days
+        ]
+        for i in range(0, len(rows), 100):
+            DBPrice.insert_many(rows[i : i + 100]).execute()
+
+
+def get_historical(symbol_yahoo, start, end):
+    """Same as Fetcher.get_historical, but using our shared http client. Empty if yahoo has no prices."""
+    url = Fetcher(symbol_yahoo, start, end).create_url("history")
+    response = http_client.get(url, headers={"User-agent": ""})  # Yahoo rejects requests with other user agents
+    if response.status != 200:
+        log.warning("{}: Received {} for prices".format(symbol_yahoo, response.status))
+        return pd.DataFrame()
+    return pd.read_csv(StringIO(response.data.decode("utf-8")), sep=",")
 
 
 class ThreadPriceService(object):
+    """
+    Fetches prices in worker threads and keeps the results for the rest of the run. Asking for a price that is already
+    being fetched waits for that fetch instead of starting another one.
+    """
+
     pool = ThreadPoolExecutor(max_workers=10)
-    queue = []
+    futures = {}  # (yahoo symbol, day) to future of the price
+    lock = Lock()
+
+    def submit(self, instrument, my_date=None):
+        key = (instrument.symbol_yahoo, (my_date or datetime.now()).date())
+        with self.lock:
+            future = self.futures.get(key)
+            if future is None or (future.done() and future.exception()):
+                future = self.pool.submit(PriceService(instrument).get, my_date)
+                self.futures[key] = future
+        return future
 
-    def submit(self, instrument, my_date):
-        key = "{}-{}".format(instrument.symbol_ib, my_date or "today")
-        if key not in self.queue:
-            self.queue.append(key)
-            self.pool.submit(PriceService(instrument).get, my_date)
+    def get(self, instrument, my_date=None):
+        return self.submit(instrument, my_date).result()
 
 
 thread_price_service = ThreadPriceService()
@@ -52,7 +52,7 @@ class ReportRealized(object):
 
 
 def main(instruments_filter, date_delta, display_currency, filter_currency):
-    reader = CSVReader(config.get("csv_path"))
+    reader = CSVReader(config.get("csv_path"), patterns=TransactionParser.patterns + [CSVReader.dividend_pattern])
     transactions = TransactionParser(
         reader,
         instruments_filter,
@@ -0,0 +1,153 @@
+from datetime import date, timedelta
+from functools import lru_cache
+
+# Calendar per yahoo symbol suffix (the exchange), symbols without suffix are traded in the US
+SUFFIX_TO_CALENDAR = {
+    "": "US",
+    "DE": "XETRA",
+    "F": "XETRA",
+    "BE": "XETRA",
+    "MI": "MILAN",
+    "AS": "EURONEXT",
+    "PA": "EURONEXT",
+    "BR": "EURONEXT",
+    "LS": "EURONEXT",
+    "AX": "ASX",
+    "TO": "TSX",
+    "V": "TSX",
+    "T": "JPX",
+}
+
+
+def get_easter(year):
+    """Easter Sunday of the gregorian calendar"""
+    a, b, c = year % 19, year // 100, year % 100
+    d = (19 * a + b - b // 4 - (b - (b + 8) // 25 + 1) // 3 + 15) % 30
+    e = (32 + 2 * (b % 4) + 2 * (c // 4) - d - c % 4) % 7
+    f = d + e - 7 * ((a + 11 * d + 22 * e) // 451) + 114
+    return date(year, f // 31, f % 31 + 1)
+
+
+def get_weekday(year, month, weekday, n):
+    """The n-th weekday (0 is Monday) of a month, the last one for n == -1"""
+    if n > 0:
+        day = date(year, month, 1)
+        return day + timedelta(days=(weekday - day.weekday()) % 7 + 7 * (n - 1))
+    day = date(year, month + 1, 1) - timedelta(days=1) if month < 12 else date(year, 12, 31)
+    return day - timedelta(days=(day.weekday() - weekday) % 7)
+
+
+def get_observed(day):
+    """Holidays on a weekend are taken on the closest weekday, as in the US"""
+    if day.weekday() == 5:
+        return day - timedelta(days=1)
+    if day.weekday() == 6:
+        return day + timedelta(days=1)
+    return day
+
+
+def get_observed_monday(days):
+    """Holidays on a weekend are taken on the next free weekdays, as in Australia and Canada"""
+    observed = []
+    for day in sorted(days):
+        while day.weekday() >= 5 or day in observed:
+            day += timedelta(days=1)
+        observed.append(day)
+    return observed
+
+
+def get_us_holidays(year):
+    easter = get_easter(year)
+    holidays = [
+        get_weekday(year, 1, 0, 3),  # Martin Luther King Jr. Day
+        get_weekday(year, 2, 0, 3),  # Washington's Birthday
+        easter - timedelta(days=2),
+        get_weekday(year, 5, 0, -1),  # Memorial Day
+        get_observed(date(year, 7, 4)),
+        get_weekday(year, 9, 0, 1),  # Labor Day
+        get_weekday(year, 11, 3, 4),  # Thanksgiving
+        get_observed(date(year, 12, 25)),
+    ]
+    if date(year, 1, 1).weekday() != 5:  # Not made up for on the 31st of December before
+        holidays.append(get_observed(date(year, 1, 1)))
+    if year >= 2022:
+        holidays.append(get_observed(date(year, 6, 19)))  # Juneteenth
+    return holidays
+
+
+def get_xetra_holidays(year):
+    easter = get_easter(year)
+    days = [(1, 1), (5, 1), (12, 24), (12, 25), (12, 26), (12, 31)]
+    return [easter - timedelta(days=2), easter + timedelta(days=1)] + [date(year, m, d) for m, d in days]
+
+
+def get_milan_holidays(year):
+    return get_xetra_holidays(year) + [date(year, 8, 15)]
+
+
+def get_euronext_holidays(year):
+    easter = get_easter(year)
+    days = [(1, 1), (5, 1), (12, 25), (12, 26)]
+    return [easter - timedelta(days=2), easter + timedelta(days=1)] + [date(year, m, d) for m, d in days]
+
+
+def get_asx_holidays(year):
+    easter = get_easter(year)
+    return (
+        [easter - timedelta(days=2), easter + timedelta(days=1), date(year, 4, 25)]  # Anzac Day is not made up for
+        + [get_weekday(year, 6, 0, 2)]  # King's Birthday
+        + get_observed_monday([date(year, 1, 1)])
+        + get_observed_monday([date(year, 1, 26)])  # Australia Day
+        + get_observed_monday([date(year, 12, 25), date(year, 12, 26)])
+    )
+
+
+def get_tsx_holidays(year):
+    easter = get_easter(year)
+    victoria_day = date(year, 5, 24) - timedelta(days=date(year, 5, 24).weekday())  # Last Monday before the 25th
+    return (
+        [easter - timedelta(days=2), get_weekday(year, 2, 0, 3), victoria_day]  # Good Friday, Family Day
+        + [get_weekday(year, 8, 0, 1), get_weekday(year, 9, 0, 1), get_weekday(year, 10, 0, 2)]
+        + get_observed_monday([date(year, 1, 1)])
+        + get_observed_monday([date(year, 7, 1)])  # Canada Day
+        + get_observed_monday([date(year, 12, 25), date(year, 12, 26)])
+    )
+
+
+def get_jpx_holidays(year):
+    return [date(year, 1, 1), date(year, 1, 2), date(year, 1, 3), date(year, 12, 31)]
+
+
+HOLIDAYS = {
+    "US": get_us_holidays,
+    "XETRA": get_xetra_holidays,
+    "MILAN": get_milan_holidays,
+    "EURONEXT": get_euronext_holidays,
+    "ASX": get_asx_holidays,
+    "TSX": get_tsx_holidays,
+    "JPX": get_jpx_holidays,
+}
+
+
+@lru_cache(maxsize=None)
+def get_holidays(calendar, year):
+    if calendar not in HOLIDAYS:
+        return frozenset()
+    return frozenset(HOLIDAYS[calendar](year))
+
+
+def get_calendar(symbol_yahoo):
+    suffix = symbol_yahoo.rsplit(".", 1)[1] if "." in symbol_yahoo else ""
+    return SUFFIX_TO_CALENDAR.get(suffix)
+
+
+def is_trading_day(symbol_yahoo, day):
+    """Whether the exchange of the symbol is open on that day. Only weekends are known for unknown exchanges."""
+    return day.weekday() < 5 and day not in get_holidays(get_calendar(symbol_yahoo), day.year)
+
+
+def get_last_trading_day(symbol_yahoo, day):
+    """The given day if the exchange is open then, else the last day before that it was open"""
+    while not is_trading_day(symbol_yahoo, day):
+        day -= timedelta(days=1)
+    return day
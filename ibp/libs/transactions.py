@@ -6,9 +6,9 @@ from datetime import date, datetime
 from .config import config
 from .corporate_actions import CorporateActionParser
 from .helpers import ignore_due_time_constraint, parse_date_delta
-from .instruments import InstrumentCollection, ignore_instrument
+from .instruments import InstrumentCollection, db, extract_symbol, ignore_instrument
 from .logging import log
-from .parser import CSVReader
+from .parser import CSVReader, compile_schema, filter_lines
 from .prices import Money
 
 TransactionRowFormat1 = namedtuple(
@@ -104,6 +104,34 @@ TransactionRowFormat5 = namedtuple(
 )
 
 
+TransactionRow = namedtuple(
+    "TransactionRow",
+    [
+        "currency",
+        "symbol_ib",
+        "timestamp",
+        "amount",
+        "transaction_price",
+        "fee",
+        "transaction_total",
+        "realized",
+        "realized_percent",
+    ],
+)
+# Column titles per TransactionRow field as found in 'Trades,Header,...' lines
+TRANSACTION_TITLES = (
+    ("Currency",),
+    ("Symbol",),
+    ("Date/Time",),
+    ("Quantity",),
+    ("T. Price",),
+    ("Comm/Fee",),
+    ("Proceeds",),
+    ("Realized P/L",),
+    ("Realized P/L %",),
+)
+
+
 class Transaction(object):
     """
     Represents a buy or sell transaction based on a csv row. Adds information that we calculate or fetch from
@@ -163,6 +191,9 @@ class Transaction(object):
 class TransactionParser(object):
     """Creates a csv-like report with stock orders (buy/sell actions)"""
 
+    # Sections of the csv files needed to list transactions
+    patterns = [CSVReader.instrument_pattern, CSVReader.transaction_pattern, CSVReader.corporate_action_pattern]
+
     def __init__(
         self,
         reader,
@@ -186,19 +217,36 @@ class TransactionParser(object):
         Sample line:
         Trades,Data,Order,Stocks - Held (...) LLC,AUD,AEF,"2019-06-16, 20:09:34",500,1.85,1.775,-925,-6,931,0,0,-37.5,O
         """
-        lines = self.reader.get_transaction_lines()
-        reader = csv.reader(lines, delimiter=",")
         self.transactions = []
-        for row in reader:
-            transaction = self._parse_row_to_namedtuple(row)
-            transaction = self._namedtuple_to_instance(transaction)
-            if transaction:  # not-True here means this transaction should be ignored (duplicate, filtered out, etc)
-                self.transactions.append(transaction)
+        self.transaction_files = {}  # (timestamp, con_id or symbol, amount, price) to file first read from
+        self.duplicates = []  # (transaction, file) of rejected duplicates
+        conditions = self._get_line_conditions()
+        for csv_filename, header, lines in self.reader.get_transaction_sections(self.date_delta):
+            lines = filter_lines(lines, header, TransactionRow, TRANSACTION_TITLES, conditions)
+            extract = compile_schema(header, TransactionRow, TRANSACTION_TITLES, optional=("realized_percent",))
+            for row in csv.reader(lines, delimiter=","):
+                transaction = extract(row) if extract else self._parse_row_to_namedtuple(row)
+                transaction = self._namedtuple_to_instance(transaction, csv_filename)
+                if transaction:  # not-True means this transaction should be ignored (duplicate, filtered out, etc)
+                    self.transactions.append(transaction)
         self.transactions = sorted(self.transactions, key=lambda t: t.timestamp)
         return self.transactions
 
+    def _get_line_conditions(self):
+        """Currency and instrument filters to apply to csv lines before parsing them, see filter_lines."""
+        conditions = {}
+        if self.filter_currency:
+            conditions["currency"] = lambda currency: currency == self.filter_currency
+        if self.instruments.instrument_filter:
+            aliases = db.get_aliases(self.instruments.instrument_filter)
+            conditions["symbol_ib"] = lambda symbol: symbol in aliases or extract_symbol(symbol) in aliases
+        return conditions
+
     def _parse_row_to_namedtuple(self, row):
-        """Single line in csv file to python namedtuple w/o adding or calculating additional data"""
+        """
+        Single line in csv file to python namedtuple w/o adding or calculating additional data. Guesses the format for
+        lines without a usable header line.
+        """
         row_starts = (
             [
                 "Trades",
@@ -225,7 +273,7 @@ class TransactionParser(object):
             raise Exception("Unknown transaction row format. Length {}. {}".format(len(row), row))
         return transaction
 
-    def _namedtuple_to_instance(self, transaction_tuple):
+    def _namedtuple_to_instance(self, transaction_tuple, csv_filename=None):
         if ignore_instrument(
             None, [transaction_tuple.symbol_ib], self.instruments.instrument_filter, transaction_tuple.currency
         ):
@@ -249,22 +297,32 @@ class TransactionParser(object):
         transaction_price = Money(float(transaction_tuple.transaction_price), transaction_tuple.currency)
         transaction_total = Money(float(transaction_tuple.transaction_total), transaction_tuple.currency)
         instrument = self.instruments.get(transaction_tuple.symbol_ib, transaction_tuple.currency)
+        key = (
+            timestamp,
+            instrument.symbol_ib if instrument.con_id == "?" else instrument.con_id,
+            amount,
+            transaction_price.as_float,
+        )
+        if self.transaction_files.get(key, csv_filename) != csv_filename:
+            # Avoids trades that are in more than one csv to be added more than once. Equal fills within one csv are
+            # separate trades though.
+            log.debug(
+                "{} {}: Skipping duplicate of {} at {} from {}, first read from {}".format(
+                    *key, csv_filename, self.transaction_files[key]
+                )
+            )
+            self.duplicates.append((transaction_tuple, csv_filename))
+            return None
+        self.transaction_files[key] = csv_filename
         instrument.get_price_in_background()
         try:
             realized_percent = float(transaction_tuple.realized_percent) / 100
-        except AttributeError:
+        except (AttributeError, TypeError):  # Format without the column
             realized_percent = None
 
-        transaction = Transaction(
+        return Transaction(
             timestamp, instrument, amount, transaction_price, fee, realized, transaction_total, realized_percent
         )
-        if [
-            t
-            for t in self.transactions
-            if t.timestamp == transaction.timestamp and t.instrument == transaction.instrument
-        ]:
-            return None  # Avoids trades that are in more than one csv to be added more than once
-        return transaction
 
 
 class TransactionPrinter(object):
@@ -369,7 +427,7 @@ class TransactionPrinter(object):
 
 
 def main(instruments_filter, only_sell, only_buy, display_currency, filter_currency, date_delta, machine_readable):
-    reader = CSVReader(config.get("csv_path"))
+    reader = CSVReader(config.get("csv_path"), patterns=TransactionParser.patterns)
     t = TransactionParser(reader, instruments_filter, only_sell, only_buy, filter_currency, date_delta)
     transactions = t.get_csv_transactions()
     CorporateActionParser(reader).apply_actions(transactions)
@@ -1,11 +1,11 @@
 import re
+from concurrent.futures import ThreadPoolExecutor
 from difflib import SequenceMatcher
-from time import sleep
-from urllib import request
-from urllib.error import HTTPError
 
 from .config import config
-from .exceptions import BadYahooSymbolError
+from .exceptions import BadYahooSymbolError, YahooResponseError
+from .failed_lookups import failed_lookups
+from .http_client import http_client
 from .logging import log
 
 
@@ -14,9 +14,6 @@ class YahooSymbolPageScraper(object):
     Parses info from the yahoo finance page of a stock. E.g. https://finance.yahoo.com/quote/AEF.AX
     """
 
-    # History of what has already been tried, but failed
-    tried_symbols = []
-
     def __init__(self, symbol_ib, name=None, currency=None):
         # log.debug("{}.__init__".format(self.__class__.__name__))
         self.symbol_ib = symbol_ib.rstrip("d")  # in case of 'MXHNd' IB has a 'd' at the end which is of no use
@@ -39,90 +36,76 @@ class YahooSymbolPageScraper(object):
         return result
 
     def fetch_for_eur(self, symbol):
-        suffixes = [".DE", ".F", ".MI", ".AS", ".PA", ".BR", ".LS", ".BE"]
-        for s in suffixes:
-            symbol = self.symbol_ib + s
-            try:
-                my_request = self.get_yahoo_response(symbol)
-                response = self.parse_yahoo_response(my_request)
-            except BadYahooSymbolError:
-                self.tried_symbols.append(symbol)
-            else:
-                if response[0]:
-                    return response
-        return None, None, None
+        return self.probe(self.get_eur_symbols())
 
     def fetch_for_aud(self, symbol):
-        symbol = self.symbol_ib + ".AX"
-        try:
-            my_request = self.get_yahoo_response(symbol)
-            return self.parse_yahoo_response(my_request)
-        except BadYahooSymbolError:
-            self.tried_symbols.append(symbol)
-        return None, None, None
+        return self.probe(self.get_aud_symbols())
 
     def fetch_for_cad(self, symbol):
-        suffixes = [".T", ".TO", ".V"]
-        for s in suffixes:
-            symbol = self.symbol_ib + s
-            try:
-                my_request = self.get_yahoo_response(symbol)
-                return self.parse_yahoo_response(my_request)
-            except BadYahooSymbolError:
-                self.tried_symbols.append(symbol)
-                continue
-        return None, None, None
+        return self.probe(self.get_cad_symbols())
 
     def fetch_for_unknown_currency(self):
+        return self.probe([self.symbol_ib] + self.get_eur_symbols() + self.get_aud_symbols() + self.get_cad_symbols())
+
+    def get_eur_symbols(self):
+        return [self.symbol_ib + s for s in (".DE", ".F", ".MI", ".AS", ".PA", ".BR", ".LS", ".BE")]
+
+    def get_aud_symbols(self):
+        return [self.symbol_ib + ".AX"]
+
+    def get_cad_symbols(self):
+        return [self.symbol_ib + s for s in (".T", ".TO", ".V")]
+
+    def probe(self, symbols):
+        """
+        Requests the yahoo pages of all candidate symbols at once. Returns the result of the first symbol in the list
+        yahoo knows as soon as all symbols before it failed, without waiting for the ones after it.
+        """
+        pool = ThreadPoolExecutor(max_workers=len(symbols))
+        futures = [pool.submit(self.try_symbol, symbol) for symbol in symbols]
         try:
-            my_request = self.get_yahoo_response(self.symbol_ib)
-            symbol, name, currency = self.parse_yahoo_response(my_request)
-        except BadYahooSymbolError:
-            symbol, name = None, ""
-
-        if symbol:
-            return symbol, name, currency
-
-        eur_symbol = self.fetch_for_eur(self.symbol_ib)
-        if eur_symbol[0]:
-            return eur_symbol
-        aud_symbol = self.fetch_for_aud(self.symbol_ib)
-        if aud_symbol[0]:
-            return aud_symbol
-        cad_symbol = self.fetch_for_cad(self.symbol_ib)
-        if cad_symbol[0]:
-            return cad_symbol
+            for future in futures:
+                result = future.result()
+                if result[0]:
+                    return result
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
         return None, None, None
 
-    def get_yahoo_response(self, symbol, failed_attemps=0):
-        if failed_attemps >= config.getint("instrument_fetch_max_allowed_tries"):
-            raise BadYahooSymbolError()
-        url = "https://finance.yahoo.com/quote/{}".format(symbol)
+    def try_symbol(self, symbol):
         try:
-            my_request = request.urlopen(url)
-        except HTTPError as e:
-            if e.code == 503:
-                log.warning("{:12}: Received 503 request, trying again in few seconds...".format(symbol))
-                sleep(4)
-                return self.get_yahoo_response(symbol, failed_attemps + 1)
-            if e.code == 404:
-                print(url)
-                raise BadYahooSymbolError()
-            else:
-                raise
-
-        if my_request.url != url:
+            my_request = self.get_yahoo_response(symbol)
+            return self.parse_yahoo_response(my_request)
+        except BadYahooSymbolError:
+            return None, None, None
+
+    def get_yahoo_response(self, symbol):
+        url = "https://finance.yahoo.com/quote/{}".format(symbol)
+        if failed_lookups.is_failed(url):
+            raise BadYahooSymbolError()
+        # Yahoo redirects to a search page for symbols it does not know
+        retries = config.getint("instrument_fetch_max_allowed_tries") - 1
+        my_request = http_client.get(url, retries=retries, redirect=False, cache="quote")
+        if my_request.status >= 500:
+            log.warning("{:12}: Received {} also after {} retries".format(symbol, my_request.status, retries))
+            raise BadYahooSymbolError()
+        if my_request.status == 404:
+            log.debug("{:12}: Not found: {}".format(symbol, url))
+            failed_lookups.add(url, "404")
+            raise BadYahooSymbolError()
+        if my_request.get_redirect_location():
             log.debug("{:12}: Not found".format(symbol))
+            failed_lookups.add(url, "redirected")
             raise BadYahooSymbolError()
-        else:
-            log.debug("{:12}: Found".format(symbol))
-
+        if my_request.status != 200:
+            raise YahooResponseError("{}: {}".format(url, my_request.status))
+        log.debug("{:12}: Found".format(symbol))
         return my_request
 
     def parse_yahoo_response(self, my_request):
         """Retrieve symbol ticker, full name and currency from the response from finance.yahoo.com"""
         try:
-            response = my_request.read().decode("utf-8")
+            response = my_request.data.decode("utf-8")
         except UnicodeDecodeError:
             return None, "", ""
         log.error(response)
@@ -134,10 +117,11 @@ class YahooSymbolPageScraper(object):
             symbol_base = symbol.split(".")[0]
         if not symbol_base == self.symbol_ib:
             assert_string_similarity(symbol, self.name, name)
-        if not self.currency:
-            self.currency = self._get_currency_from_response(response)
-            log.debug("{:12}: Currency on yahoo: {}".format(self.symbol_ib, self.currency))
-        return symbol, name, self.currency
+        currency = self.currency
+        if not currency:
+            currency = self._get_currency_from_response(response)
+            log.debug("{:12}: Currency on yahoo: {}".format(self.symbol_ib, currency))
+        return symbol, name, currency
 
     def _get_name_and_symbol_from_response(self, response):
         title_start = response.find("<title>") + len("<title>")
@@ -1,8 +1,10 @@
 import json
-from urllib import request
 from urllib.parse import quote
 
 from .constants import YAHOO_EXCHANGE_TO_CURRENCY
+from .exceptions import YahooResponseError
+from .failed_lookups import failed_lookups
+from .http_client import http_client
 from .logging import log
 
 
@@ -13,11 +15,18 @@ def get_yahoo_json_search_result(query):
     """
     log.debug("Query yahoo: {}".format(query))
     url = "https://query1.finance.yahoo.com/v1/finance/search?q={}".format(quote(query))
-    my_request = request.urlopen(url)
-    response = my_request.read().decode("utf-8")
-    response = json.loads(response)
+    if failed_lookups.is_failed(url):
+        return None, None, None
+    my_request = http_client.get(url, cache="search")
+    if my_request.status >= 500:
+        log.warning("{:12}: Received {} also after retrying".format(query, my_request.status))
+        return None, None, None
+    if my_request.status != 200:
+        raise YahooResponseError("{}: {}".format(url, my_request.status))
+    response = json.loads(my_request.data.decode("utf-8"))
     if len(response["quotes"]) == 0:
         log.debug("{:12}: No quotes found.".format(query))
+        failed_lookups.add(url, "no quotes")
         return None, None, None
     symbol = response["quotes"][0]["symbol"]
     try:
@@ -22,8 +22,10 @@ setuptools.setup(
     install_requires=[
         "forex-python",
         "matplotlib",
+        "numpy",
         "pandas",
         "peewee",
+        "urllib3",
         "yahoo-historical",
     ],
     entry_points={
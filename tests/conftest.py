@@ -0,0 +1,57 @@
+"""Points ibparser to a config, database and caches in a temporary home, before any of its modules is imported."""
+
+import configparser
+import os
+import shutil
+import tempfile
+from os import path
+
+import pytest
+
+home = tempfile.mkdtemp(prefix="ibparser-tests-")
+os.environ["HOME"] = home
+parser = configparser.RawConfigParser()
+parser.read(path.join(path.dirname(__file__), "../ibp/ibparser.cfg"))
+parser["ibparser"].update(
+    {
+        "csv_path": path.join(home, "ib-csv/"),
+        "db_file": path.join(home, "ibparser.db"),
+        "price_series_path": path.join(home, "prices/"),
+        "http_cache_path": path.join(home, "http-cache/"),
+        "yahoo_requests_per_second": "1000",
+        "http_backoff_seconds": "0.01",
+    }
+)
+with open(path.join(home, ".ibparser.cfg"), "w") as f:
+    parser.write(f)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def db():
+    from ibp.libs.models import db, db_writer, init_db
+
+    init_db()
+    yield db
+    db_writer.flush()
+    db.close()
+    shutil.rmtree(home)
+
+
+@pytest.fixture
+def yahoo(monkeypatch):
+    """A FakeYahoo that the shared http client sends all requests for yahoo to."""
+    from fake_yahoo import FakeYahoo
+
+    from ibp.libs.http_client import http_client
+
+    fake = FakeYahoo().start()
+    request = http_client.pool.request
+
+    def request_fake(method, url, *args, **kwargs):
+        for host in ("https://finance.yahoo.com", "https://query1.finance.yahoo.com"):
+            url = url.replace(host, fake.url)
+        return request(method, url, *args, **kwargs)
+
+    monkeypatch.setattr(http_client.pool, "request", request_fake)
+    yield fake
+    fake.stop()
@@ -0,0 +1,93 @@
+"""
+Local stand-in for the yahoo endpoints used for finding instruments: the json search and quote pages. Counts
+requests, connections and how many requests it served at the same time.
+"""
+
+import json
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlsplit
+
+QUOTE_PAGE = (
+    '<title>{0} CORP ({0}) Stock Price, Quote, History &amp; News</title><h1 class="D(ib) Fz(18px)" '
+    'data-reactid="7">{0} CORP</h1>Currency in EUR'
+)
+
+
+class FakeYahoo(object):
+    """
+    Searches find a NASDAQ listed instrument with the query as symbol, except for queries starting with NOPE, which
+    find nothing, and ERR, which get a 400. Quote pages exist for the symbols in `quotes`. Responses queued in
+    `scripted` per path are given first, as (status, headers, body).
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.quotes = set()
+        self.scripted = {}
+        self.requests = Counter()  # Path to number of requests
+        self.connections = set()  # Client addresses, one per connection
+        self.active = self.max_active = 0
+        self.lock = Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.get_handler())
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_response(self, url):
+        with self.lock:
+            scripted = self.scripted.get(url.path)
+            if scripted:
+                return scripted.pop(0)
+        query = parse_qs(url.query)
+        if url.path == "/v1/finance/search":
+            q = query["q"][0]
+            if q.startswith("ERR"):
+                return 400, {}, b""
+            quotes = [] if q.startswith("NOPE") else [{"symbol": q, "longname": q + " INC", "exchange": "NMS"}]
+            return 200, {}, json.dumps({"quotes": quotes}).encode()
+        if url.path.startswith("/quote/"):
+            symbol = url.path.rsplit("/", 1)[1]
+            if symbol in self.quotes:
+                return 200, {}, QUOTE_PAGE.format(symbol).encode()
+        return 404, {}, b""
+
+    def get_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, so connection reuse shows
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                with fake.lock:
+                    fake.requests[url.path] += 1
+                    fake.connections.add(self.client_address)
+                    fake.active += 1
+                    fake.max_active = max(fake.max_active, fake.active)
+                try:
+                    time.sleep(fake.latency)
+                    status, headers, body = fake.get_response(url)
+                finally:
+                    with fake.lock:
+                        fake.active -= 1
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
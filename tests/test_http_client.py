@@ -0,0 +1,52 @@
+import time
+
+from ibp.libs.http_client import HTTPClient
+
+
+def test_connections_are_reused_per_host(yahoo):
+    client = HTTPClient()
+    for i in range(5):
+        assert client.get("{}/v1/finance/search?q=REUSE{}".format(yahoo.url, i)).status == 200
+    assert len(yahoo.connections) == 1
+    other_host = yahoo.url.replace("127.0.0.1", "localhost")
+    for i in range(5):
+        assert client.get("{}/v1/finance/search?q=REUSE{}".format(other_host, i)).status == 200
+    assert len(client.pool.pools) == 2
+    assert len(yahoo.connections) == 2
+    assert client.get_stats()["127.0.0.1"][0] == client.get_stats()["localhost"][0] == 5
+
+
+def test_retries_until_success(yahoo):
+    yahoo.quotes.add("FLAKY")
+    yahoo.scripted["/quote/FLAKY"] = [(503, {}, b""), (503, {}, b"")]
+    response = HTTPClient().get("{}/quote/FLAKY".format(yahoo.url), retries=2)
+    assert response.status == 200
+    assert b"FLAKY CORP" in response.data
+    assert yahoo.requests["/quote/FLAKY"] == 3
+
+
+def test_gives_up_after_retries(yahoo):
+    yahoo.scripted["/quote/DOWN"] = [(503, {}, b"")] * 3
+    assert HTTPClient().get("{}/quote/DOWN".format(yahoo.url), retries=1).status == 503
+    assert yahoo.requests["/quote/DOWN"] == 2
+
+
+def test_honors_retry_after(yahoo):
+    yahoo.scripted["/v1/finance/search"] = [(429, {"Retry-After": "1"}, b"")]
+    start = time.monotonic()
+    response = HTTPClient().get("{}/v1/finance/search?q=LIMITED".format(yahoo.url))
+    assert response.status == 200
+    assert yahoo.requests["/v1/finance/search"] == 2
+    assert time.monotonic() - start >= 1  # Instead of http_backoff_seconds
+
+
+def test_cache_hit_makes_no_request(yahoo):
+    yahoo.quotes.add("CACHED")
+    url = "{}/quote/CACHED".format(yahoo.url)
+    client = HTTPClient()
+    first = client.get(url, cache="quote")
+    second = client.get(url, cache="quote")
+    assert second.status == 200
+    assert second.data == first.data
+    assert yahoo.requests["/quote/CACHED"] == 1
+    assert client.cache_hits == 1
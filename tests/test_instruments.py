@@ -0,0 +1,56 @@
+import time
+
+import pytest
+
+from ibp.libs.config import config
+from ibp.libs.exceptions import YahooResponseError
+from ibp.libs.instruments import InstrumentParser, db
+
+
+def get_instruments_args(prefix, count, failing=()):
+    """Arguments for Instrument of count NASDAQ instruments, whose search for the security id fails for the failing."""
+    return [
+        (
+            "{}{}".format(prefix, i),
+            "{}{} INC".format(prefix, i),
+            "{}-{}".format(prefix, i),
+            "{}{}{}".format("ERR" if i in failing else "US", prefix, i),
+            "USD",
+            [],
+        )
+        for i in range(count)
+    ]
+
+
+@pytest.fixture
+def parser():
+    return InstrumentParser(reader=None)
+
+
+def test_failed_lookup_keeps_the_others(yahoo, parser):
+    with pytest.raises(YahooResponseError):
+        parser._create_instruments(get_instruments_args("FAIL", 5, failing=[2]))
+    assert db.get("FAIL-2") is None
+    for i in (0, 1, 3, 4):
+        assert db.get("FAIL-{}".format(i)).symbol_yahoo == "USFAIL{}".format(i)
+
+
+def test_instruments_are_added_in_one_batch(yahoo, parser, monkeypatch):
+    batches = []
+    monkeypatch.setattr(db, "add", lambda instrument: batches.append([instrument]))
+    add_many = db.add_many
+    monkeypatch.setattr(db, "add_many", lambda instruments: batches.append(instruments) or add_many(instruments))
+    instruments = parser._create_instruments(get_instruments_args("BATCH", 5))
+    assert [sorted(i.con_id for i in batch) for batch in batches] == [["BATCH-{}".format(i) for i in range(5)]]
+    assert all(db.get(i.con_id) for i in instruments)
+
+
+def test_lookups_run_concurrently(yahoo, parser):
+    yahoo.latency = 0.2
+    start = time.monotonic()
+    instruments = parser._create_instruments(get_instruments_args("CONC", 8))
+    elapsed = time.monotonic() - start
+    assert len(instruments) == 8
+    assert yahoo.requests["/v1/finance/search"] == 8
+    assert yahoo.max_active == min(config.getint("yahoo_workers"), 8)
+    assert elapsed < 8 * yahoo.latency / 2
@@ -0,0 +1,90 @@
+from datetime import date, datetime
+from types import SimpleNamespace
+
+import pytest
+from peewee import SqliteDatabase
+
+from ibp.libs.models import (
+    LOOKUP_INDEXES,
+    MIGRATIONS,
+    TABLES,
+    Instrument,
+    db,
+    db_writer,
+    get_schema_version,
+)
+from ibp.libs.money import forex_converter
+from ibp.libs.price_series import price_series
+from ibp.libs.prices import PriceService
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    """The SELECTs run on the database, as (sql, params)."""
+    queries = []
+    execute_sql = db.execute_sql
+
+    def record(sql, params=None, *args, **kwargs):
+        if sql.startswith("SELECT"):
+            queries.append((sql, params))
+        return execute_sql(sql, params, *args, **kwargs)
+
+    monkeypatch.setattr(db, "execute_sql", record)
+    return queries
+
+
+def get_plan(sql, params):
+    return " ".join(row[-1] for row in db.execute_sql("EXPLAIN QUERY PLAN " + sql, params).fetchall())
+
+
+@pytest.fixture(scope="module")
+def instrument():
+    return db_writer.run(
+        Instrument.create,
+        name="ABC CORP",
+        symbol_ib="ABC",
+        symbol_yahoo="ABC.PA",
+        con_id="1",
+        security_id="FR0000000001",
+        currency="EUR",
+    )
+
+
+def test_migrations_create_lookup_indexes():
+    assert get_schema_version() == len(MIGRATIONS)
+    indexes = set(index.name for model, _ in LOOKUP_INDEXES for index in db.get_indexes(model._meta.table_name))
+    assert {
+        "instrument_symbol_ib",
+        "price_instrument_id_datetime",
+        "currencyrate_currency_a_currency_b_date",
+    } <= indexes
+
+
+def test_lookup_indexes_are_not_created_with_tables():
+    """Else a new database would have them before add_lookup_indexes runs, which then fails or does nothing."""
+    fresh_db = SqliteDatabase(":memory:")
+    with fresh_db.bind_ctx(TABLES):
+        fresh_db.create_tables(TABLES)
+        for model, columns in LOOKUP_INDEXES:
+            assert columns not in [tuple(index.columns) for index in fresh_db.get_indexes(model._meta.table_name)]
+
+
+def test_price_series_uses_index(instrument, queries):
+    price_series._build(instrument.id)
+    assert "price_instrument_id_datetime (instrument_id=?)" in get_plan(*queries[-1])
+
+
+def test_price_insert_uses_index(instrument, queries):
+    service = PriceService(SimpleNamespace(_db_instrument=instrument))
+    service._insert_prices([(datetime(2022, 3, 1), 100.0), (datetime(2022, 3, 2), 101.0)])
+    assert "price_instrument_id_datetime (instrument_id=? AND datetime>? AND datetime<?)" in get_plan(*queries[0])
+
+
+def test_currency_rates_use_index(queries):
+    forex_converter._get_rates(date(2022, 3, 1))
+    assert "currencyrate_currency_a_currency_b_date (currency_a=? AND currency_b=? AND date=?)" in get_plan(*queries[0])
+
+
+def test_instrument_by_symbol_uses_index(queries):
+    list(Instrument.select().where(Instrument.symbol_ib == "ABC"))
+    assert "instrument_symbol_ib (symbol_ib=?)" in get_plan(*queries[0])